@@ -0,0 +1,82 @@
+import logging.config
+import os
+import uuid
+from typing import Any
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi_cache.backends.redis import RedisCacheBackend
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.core.config import app_settings
+from src.db.db import get_session
+from src.schemas import archive_schemas
+from src.schemas.user_schemas import CurrentUser
+from src.services.archive import MEDIA_TYPES, get_file_extension
+from src.services.archive_jobs import (get_archive_job, get_archive_key,
+                                       submit_archive_job)
+from src.services.base import user_crud
+from src.services.cache import redis_cache
+from src.services.responses import send_stored_file
+
+router = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+
+@router.post('/files/archives',
+             response_model=archive_schemas.ArchiveJob,
+             status_code=status.HTTP_202_ACCEPTED,
+             description='Start building an archive in background.')
+async def create_archive_job(
+        path: str = Query(description='<path-to-folder>||<folder-meta-id>'),
+        compression_type: str = Query(
+            description='(zip, 7z, tar, tar.zst, zip-store, tar-store)'),
+        db: AsyncSession = Depends(get_session),
+        current_user: CurrentUser = Depends(user_crud.get_current_user),
+        cache: RedisCacheBackend = Depends(redis_cache)
+) -> Any:
+    """
+    Queue an archive job, the same request returns the same job.
+    """
+    if compression_type not in app_settings.compression_types:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'{compression_type} is not supported.')
+    return await submit_archive_job(db=db,
+                                    cache=cache,
+                                    user_obj=current_user,
+                                    path=path,
+                                    compression_type=compression_type)
+
+
+@router.get('/files/archives/{job_id}',
+            response_model=archive_schemas.ArchiveJob,
+            description='Get archive job status.')
+async def get_archive_job_status(
+        job_id: uuid.UUID,
+        current_user: CurrentUser = Depends(user_crud.get_current_user)
+) -> Any:
+    return await get_archive_job(user_obj=current_user, job_id=job_id)
+
+
+@router.get('/files/archives/{job_id}/download',
+            description='Download archive built by a job.')
+async def download_archive(
+        job_id: uuid.UUID,
+        request: Request,
+        current_user: CurrentUser = Depends(user_crud.get_current_user)
+) -> Any:
+    job = await get_archive_job(user_obj=current_user, job_id=job_id)
+    if job['status'] != 'done':
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f'Archive is {job["status"]}.')
+    compression_type = job['compression_type']
+    folder_name = os.path.basename(job['path']) or 'archive'
+    logger.info('User %s download archive of %s',
+                current_user.id, job['path'])
+    return await send_stored_file(
+        get_archive_key(job),
+        media_type=MEDIA_TYPES[compression_type],
+        filename=f'{folder_name}.{get_file_extension(compression_type)}',
+        request=request)
@@ -1,23 +1,30 @@
+import hashlib
+import json
 import logging.config
+import os
 from datetime import datetime
 from typing import Any, Optional
 
 import redis.asyncio as redis
-from fastapi import (APIRouter, Depends, File, HTTPException, Query,
+from fastapi import (APIRouter, Depends, File, HTTPException, Query, Request,
                      UploadFile, status)
 from fastapi_cache.backends.redis import RedisCacheBackend
 from sqlalchemy.ext.asyncio import AsyncSession
-from starlette.responses import FileResponse, StreamingResponse
+from starlette.responses import StreamingResponse
 
 from src.core.config import app_settings
-from src.db.db import get_session
-from src.schemas import file_schemas
+from src.db.db import get_cache_ttl, get_read_session, get_session
+from src.schemas import file_schemas, user_schemas
 from src.schemas.user_schemas import CurrentUser
-from src.services.base import file_crud, user_crud
-from src.services.cache import (get_cache, get_cache_or_data, redis_cache,
-                                set_cache)
+from src.services.archive import get_file_extension
+from src.services.base import directory_crud, file_crud, user_crud
+from src.services.cache import (get_cache, get_cache_or_data, get_file_key,
+                                get_files_list_key, redis_cache, set_cache)
+from src.services.files import StagedFile, get_upload_size, stage_file
+from src.services.responses import get_etag, send_file, send_stored_file
+from src.services.storage import get_storage_key, storage
 from src.services.utils import (get_compressed_file_with_media_type,
-                                get_file_info)
+                                get_file_info, get_files_info)
 
 router = APIRouter()
 
@@ -28,27 +35,175 @@ logger = logging.getLogger(__name__)
             response_model=file_schemas.FilesList,
             description='Get files list of current user.')
 async def get_files(
-        db: AsyncSession = Depends(get_session),
+        limit: int = Query(app_settings.files_list_default_limit,
+                           ge=1,
+                           le=app_settings.files_list_max_limit),
+        cursor: Optional[str] = Query(None,
+                                      description='next_cursor of the '
+                                                  'previous page.'),
+        order_by: str = Query('created_at', regex='^(created_at|path)$'),
+        path_prefix: Optional[str] = None,
+        min_size: Optional[int] = Query(None, ge=0),
+        max_size: Optional[int] = Query(None, ge=0),
+        created_after: Optional[datetime] = None,
+        created_before: Optional[datetime] = None,
+        fields: Optional[list[str]] = Query(None,
+                                            description='Fields of file to '
+                                                        'return.'),
+        db: AsyncSession = Depends(get_read_session),
         current_user: CurrentUser = Depends(user_crud.get_current_user),
         cache: RedisCacheBackend = Depends(redis_cache)) -> Any:
     """
-    Get list files on service.
+    Get list files on service page by page.
     """
-    redis_key = f'files_for_user_id_{str(current_user.id)}'
+    file_fields = list(file_schemas.FileBase.__fields__)
+    fields = fields or file_fields
+    if not set(fields) <= set(file_fields):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Fields must be of {file_fields}.')
+    params = {
+        'limit': limit,
+        'order_by': order_by,
+        'cursor': cursor,
+        'fields': fields,
+        'path_prefix': path_prefix,
+        'min_size': min_size,
+        'max_size': max_size,
+        'created_after': created_after,
+        'created_before': created_before,
+    }
+    params_hash = hashlib.md5(
+        json.dumps(params, default=str, sort_keys=True).encode()
+    ).hexdigest()
+    redis_key = await get_files_list_key(cache, current_user.id, params_hash)
     data = await get_cache(cache, redis_key)
     if not data:
-        files = await file_crud.get_list_by_user_object(db=db,
-                                                        user_obj=current_user)
-        file_list = [file_schemas.File.from_orm(file).dict() for file in files]
+        files, next_cursor = await file_crud.get_page_by_user_object(
+            db=db,
+            user_obj=current_user,
+            **params)
         data = {
             'account_id': current_user.id,
-            'files': file_list
+            'files': files,
+            'next_cursor': next_cursor
         }
-        await set_cache(cache, data, redis_key)
+        await set_cache(cache,
+                        data,
+                        redis_key,
+                        expire=get_cache_ttl(
+                            db, app_settings.files_list_cache_ttl))
     logger.info('Send list of files of %s', current_user.id)
     return data
 
 
+@router.get('/files/search',
+            response_model=file_schemas.FilesList,
+            description='Search files of current user by path and name.')
+async def search_files(
+        path_prefix: Optional[str] = Query(None,
+                                           description='Path starts with.'),
+        name: Optional[str] = Query(None,
+                                    description='Name contains, case '
+                                                'insensitive.'),
+        path_contains: Optional[str] = Query(None,
+                                             description='Path contains, '
+                                                         'case insensitive.'),
+        glob: Optional[str] = Query(None,
+                                    description='Name like *.txt or path '
+                                                'like /docs/*/a?.txt.'),
+        limit: int = Query(app_settings.files_list_default_limit,
+                           ge=1,
+                           le=app_settings.files_list_max_limit),
+        cursor: Optional[str] = Query(None,
+                                      description='next_cursor of the '
+                                                  'previous page.'),
+        db: AsyncSession = Depends(get_read_session),
+        current_user: CurrentUser = Depends(user_crud.get_current_user)
+) -> Any:
+    """
+    Find files page by page, pages are sorted by path.
+    """
+    if not any((path_prefix, name, path_contains, glob)):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Set path_prefix, name, path_contains or glob.')
+    files, next_cursor = await file_crud.get_page_by_user_object(
+        db=db,
+        user_obj=current_user,
+        limit=limit,
+        order_by='path',
+        cursor=cursor,
+        fields=list(file_schemas.FileBase.__fields__),
+        path_prefix=path_prefix,
+        name=name,
+        path_contains=path_contains,
+        glob=glob)
+    logger.info('Send %s found files to %s', len(files), current_user.id)
+    return {
+        'account_id': current_user.id,
+        'files': files,
+        'next_cursor': next_cursor
+    }
+
+
+@router.get('/files/folders',
+            response_model=file_schemas.FolderInfo,
+            description='Get size of a folder and its subfolders.')
+async def get_folder_info(
+        path: str = Query('/', description='Path to folder start with /'),
+        db: AsyncSession = Depends(get_read_session),
+        current_user: CurrentUser = Depends(user_crud.get_current_user)
+) -> Any:
+    """
+    Get counters of a folder and of its subfolders.
+    """
+    if not path.startswith('/'):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Path must starts with / .')
+    folder, folders = await directory_crud.get_dir_with_children(
+        db=db,
+        dir_path=path,
+        user_id=current_user.id)
+    if folder is None and path.strip('/'):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail='Directory not found')
+    logger.info('Send folder %s to %s', path, current_user.id)
+    return {'folder': folder, 'folders': folders}
+
+
+@router.post('/files/info',
+             response_model=file_schemas.FilesInfo,
+             description='Get info of many files by paths or ids.')
+async def get_files_info_by_paths(
+        request_data: file_schemas.FilesInfoRequest,
+        db: AsyncSession = Depends(get_read_session),
+        current_user: CurrentUser = Depends(user_crud.get_current_user),
+        cache: RedisCacheBackend = Depends(redis_cache)) -> Any:
+    """
+    Get files info in one request.
+    """
+    files, not_found = await get_files_info(db=db,
+                                            cache=cache,
+                                            user_id=current_user.id,
+                                            paths=request_data.paths)
+    logger.info('Send info of %s files to %s', len(files), current_user.id)
+    return {'files': files, 'not_found': not_found}
+
+
+def get_content_length(request: Request) -> int:
+    """
+    Declared size of request body, a body without it can't be checked
+    against quota before it is stored.
+    """
+    content_length = request.headers.get('content-length', '')
+    if not content_length.isdigit():
+        raise HTTPException(
+            status_code=status.HTTP_411_LENGTH_REQUIRED,
+            detail='Content-Length is required.')
+    return int(content_length)
+
+
 @router.post('/files/upload',
              response_model=file_schemas.FileBase,
              status_code=status.HTTP_201_CREATED,
@@ -72,6 +227,12 @@ async def upload_file(
         full_path = path
     else:
         full_path = path + '/' + file.filename
+    # the form is received before the call, the file is checked before
+    # it is copied to storage
+    await file_crud.check_quota(db=db,
+                                user_obj=current_user,
+                                file_path=full_path,
+                                size=await get_upload_size(file))
     file_obj = await file_crud.create_or_put_file(db=db,
                                                   user_obj=current_user,
                                                   file_obj=file,
@@ -80,55 +241,141 @@ async def upload_file(
     return file_obj
 
 
+@router.put('/files/upload',
+            response_model=file_schemas.FileBase,
+            status_code=status.HTTP_201_CREATED,
+            description='Upload file from raw request body.')
+async def upload_raw_file(
+        request: Request,
+        path: str = Query(description='Full path of new file start with /'),
+        sha256: Optional[str] = Query(default=None,
+                                      description='SHA-256 of file content '
+                                                  '(Optional).'),
+        db: AsyncSession = Depends(get_session),
+        current_user: CurrentUser = Depends(user_crud.get_current_user)):
+    """
+    Upload file without multipart, body is written once to the storage.
+
+    If sha256 of content the user already stores is given, the body is
+    not read at all.
+    """
+    if not path.startswith('/') or path.endswith('/'):
+        logger.info('Not correct path in request.')
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Path must starts with / and contain file name.')
+    filename = path.split('/')[-1]
+    await file_crud.check_quota(db=db,
+                                user_obj=current_user,
+                                file_path=path,
+                                size=get_content_length(request))
+    size = None
+    if sha256 and app_settings.dedup_enabled and storage.is_local:
+        sha256 = sha256.lower()
+        size = await file_crud.has_content(db=db,
+                                           user_obj=current_user,
+                                           blob_hash=sha256)
+    if size is not None:
+        staged_file = StagedFile(filename=filename,
+                                 temp_path=None,
+                                 size=size,
+                                 sha256=sha256)
+    else:
+        # the connection goes back to the pool while the body is received,
+        # the file is saved in a new transaction
+        await db.commit()
+        staged_file = await stage_file(request.stream(), filename)
+    try:
+        if sha256 and sha256.lower() != staged_file.sha256:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail='Checksum mismatch.')
+        file_obj = await file_crud.create_or_put_file(db=db,
+                                                      user_obj=current_user,
+                                                      file_obj=staged_file,
+                                                      file_path=path)
+    finally:
+        staged_file.discard()
+    logger.info('Upload new file success.')
+    return file_obj
+
+
 @router.get('/files/download',
             status_code=status.HTTP_200_OK,
             description='Download file.')
 async def download_file(
-        db: AsyncSession = Depends(get_session),
+        request: Request,
+        db: AsyncSession = Depends(get_read_session),
         current_user: CurrentUser = Depends(user_crud.get_current_user),
         path: str = Query(description="[<path-to-file>||<file-meta-id>||"
                                       "<path-to-folder>||<folder-meta-id>] & "
-                                      "compression_type=[zip||tar||7z]"),
-        compression_type: Optional[str] = Query(default=None,
-                                                description='(zip, 7z, tar) '
-                                                            '(Optional).'),
+                                      "compression_type=[zip||tar||7z||"
+                                      "tar.zst||zip-store||tar-store]"),
+        compression_type: Optional[str] = Query(
+            default=None,
+            description='(zip, 7z, tar, tar.zst, zip-store, tar-store) '
+                        '(Optional).'),
         cache: RedisCacheBackend = Depends(redis_cache)) -> Any:
     """
     Download files/archive from service.
     """
     if not compression_type:
-        file_by_path_redis_key = f'file_by_path_{path}'
         file_info = await get_cache_or_data(
-            redis_key=file_by_path_redis_key,
+            redis_key=get_file_key(current_user.id, path),
             cache=cache,
             db_func_obj=get_file_info,
             data_schema=file_schemas.File,
-            db_func_args=(db, path))
+            db_func_args=(db, path, current_user.id),
+            cache_expire=get_cache_ttl(db, app_settings.file_cache_ttl))
         if not file_info.get('is_downloadable'):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail='Access dined.')
-        return FileResponse(
-            app_settings.files_folder_path + file_info.get('path'),
+        file = file_schemas.File.parse_obj(file_info)
+        return await send_stored_file(
+            get_storage_key(file.path, file.storage_path),
             media_type='application/octet-stream',
-            filename=file_info.get('name'))
+            filename=file.name,
+            request=request,
+            etag=get_etag(file.size, file.created_at),
+            last_modified=file.created_at)
     if compression_type not in app_settings.compression_types:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f'{compression_type} is not supported.')
-    refreshed_io, media_type = await get_compressed_file_with_media_type(
+    archive, media_type = await get_compressed_file_with_media_type(
         db=db,
         cache=cache,
+        user_obj=current_user,
         path=path,
         compression_type=compression_type)
-    file_name = 'archive' + '.' + compression_type
+    file_name = 'archive' + '.' + get_file_extension(compression_type)
     logger.info('User %s download file %s', current_user.id, path)
+    if isinstance(archive, str):
+        return send_file(archive,
+                         media_type=media_type,
+                         filename=file_name,
+                         request=request,
+                         etag=f'"{os.path.basename(archive)}"')
     return StreamingResponse(
-        iter([refreshed_io.getvalue()]),
+        archive,
         media_type=media_type,
         headers={"Content-Disposition": f'attachment;filename={file_name}'})
 
 
+@router.get('/usage',
+            response_model=user_schemas.Usage,
+            description='Get storage usage and quotas of current user.')
+async def get_usage(
+        db: AsyncSession = Depends(get_read_session),
+        current_user: CurrentUser = Depends(user_crud.get_current_user)
+) -> Any:
+    """
+    Get stored bytes and files of current user.
+    """
+    return await user_crud.get_usage(db=db, user_id=current_user.id)
+
+
 @router.get('/ping',
             description="Ping postgres and redis",
             status_code=status.HTTP_200_OK)
@@ -0,0 +1,121 @@
+import logging.config
+import uuid
+from typing import Any
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.db.db import get_session
+from src.schemas import file_schemas, upload_schemas
+from src.schemas.user_schemas import CurrentUser
+from src.services.base import file_crud, upload_crud, user_crud
+from src.services.files import is_reserved_path
+
+router = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+
+@router.post('/files/uploads',
+             response_model=upload_schemas.UploadSession,
+             status_code=status.HTTP_201_CREATED,
+             description='Start resumable upload.')
+async def create_upload_session(
+        path: str = Query(description='Full path of new file start with /'),
+        size: int = Query(ge=0, description='File size in bytes'),
+        db: AsyncSession = Depends(get_session),
+        current_user: CurrentUser = Depends(user_crud.get_current_user)
+) -> Any:
+    """
+    Create upload session, chunks are sent to it with PUT.
+    """
+    if not path.startswith('/') or path.endswith('/'):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Path must starts with / and contain file name.')
+    if is_reserved_path(path):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Path is reserved.')
+    await file_crud.check_quota(db=db,
+                                user_obj=current_user,
+                                file_path=path,
+                                size=size)
+    session = await upload_crud.create_session(db=db,
+                                               user_obj=current_user,
+                                               file_path=path,
+                                               size=size)
+    logger.info('Start upload session %s', session.id)
+    return session
+
+
+@router.get('/files/uploads/{session_id}',
+            response_model=upload_schemas.UploadSession,
+            description='Get resumable upload status.')
+async def get_upload_session(
+        session_id: uuid.UUID,
+        db: AsyncSession = Depends(get_session),
+        current_user: CurrentUser = Depends(user_crud.get_current_user)
+) -> Any:
+    """
+    Return received offset to continue upload from.
+    """
+    return await upload_crud.get_session(db=db,
+                                         user_obj=current_user,
+                                         session_id=session_id)
+
+
+@router.put('/files/uploads/{session_id}',
+            response_model=upload_schemas.UploadSession,
+            description='Upload chunk, request body is written at offset.')
+async def upload_chunk(
+        session_id: uuid.UUID,
+        request: Request,
+        offset: int = Query(ge=0, description='Chunk position in file'),
+        db: AsyncSession = Depends(get_session),
+        current_user: CurrentUser = Depends(user_crud.get_current_user)
+) -> Any:
+    """
+    Write chunk of resumable upload.
+    """
+    return await upload_crud.write_chunk(db=db,
+                                         user_obj=current_user,
+                                         session_id=session_id,
+                                         offset=offset,
+                                         chunks=request.stream())
+
+
+@router.post('/files/uploads/{session_id}/commit',
+             response_model=file_schemas.FileBase,
+             status_code=status.HTTP_201_CREATED,
+             description='Finish resumable upload.')
+async def commit_upload_session(
+        session_id: uuid.UUID,
+        db: AsyncSession = Depends(get_session),
+        current_user: CurrentUser = Depends(user_crud.get_current_user)
+) -> Any:
+    """
+    Save uploaded file to its path.
+    """
+    file_obj = await upload_crud.commit_session(db=db,
+                                                user_obj=current_user,
+                                                session_id=session_id)
+    logger.info('Upload session %s finished.', session_id)
+    return file_obj
+
+
+@router.delete('/files/uploads/{session_id}',
+               status_code=status.HTTP_204_NO_CONTENT,
+               description='Cancel resumable upload.')
+async def delete_upload_session(
+        session_id: uuid.UUID,
+        db: AsyncSession = Depends(get_session),
+        current_user: CurrentUser = Depends(user_crud.get_current_user)):
+    """
+    Drop upload session and received data.
+    """
+    session = await upload_crud.get_session(db=db,
+                                            user_obj=current_user,
+                                            session_id=session_id)
+    await upload_crud.delete_session(db=db, session=session)
+    logger.info('Upload session %s canceled.', session_id)
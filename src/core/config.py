@@ -1,5 +1,6 @@
 import os
 from logging import config as logging_config
+from typing import Literal, Optional
 
 from pydantic import BaseSettings, Field, PostgresDsn
 
@@ -14,6 +15,18 @@ NUMBER_OF_DELETED_SYMBOLS = len(BASE_DIR.split('/')[-1]) + 1
 class AppSettings(BaseSettings):
     app_title: str
     database_dsn: PostgresDsn
+    database_replica_dsn: Optional[PostgresDsn] = Field(
+        None,
+        env='DATABASE_REPLICA_DSN'
+    )
+    database_echo: bool = Field(False, env='DATABASE_ECHO')
+    database_pool_size: int = Field(10, env='DATABASE_POOL_SIZE')
+    database_max_overflow: int = Field(20, env='DATABASE_MAX_OVERFLOW')
+    database_pool_timeout: float = Field(30, env='DATABASE_POOL_TIMEOUT')
+    database_pool_recycle: int = Field(1800, env='DATABASE_POOL_RECYCLE')
+    database_pool_pre_ping: bool = Field(True, env='DATABASE_POOL_PRE_PING')
+    database_statement_cache_size: int = Field(
+        500, env='DATABASE_STATEMENT_CACHE_SIZE')
     project_name: str
     PROJECT_HOST: str
     PROJECT_PORT: int
@@ -33,10 +46,106 @@ class AppSettings(BaseSettings):
         ),
         env='FILES_BASE_DIR'
     )
+    storage_layout: Literal['mirror', 'sharded'] = Field(
+        'mirror',
+        env='STORAGE_LAYOUT'
+    )
+    storage_backend: Literal['local', 's3', 'volumes'] = Field(
+        'local',
+        env='STORAGE_BACKEND'
+    )
+    storage_volumes: list = Field([], env='STORAGE_VOLUMES')
+    storage_replicas: int = Field(1, env='STORAGE_REPLICAS')
+    storage_virtual_nodes: int = Field(100, env='STORAGE_VIRTUAL_NODES')
+    s3_bucket: str = Field('files', env='S3_BUCKET')
+    s3_endpoint_url: Optional[str] = Field(None, env='S3_ENDPOINT_URL')
+    s3_region: Optional[str] = Field(None, env='S3_REGION')
+    s3_access_key: Optional[str] = Field(None, env='S3_ACCESS_KEY')
+    s3_secret_key: Optional[str] = Field(None, env='S3_SECRET_KEY')
+    s3_part_size: int = Field(8 * 1024 * 1024, env='S3_PART_SIZE')
+    s3_max_concurrency: int = Field(4, env='S3_MAX_CONCURRENCY')
     compression_types: list = Field(
-        ['zip', '7z', 'tar'],
+        ['zip', '7z', 'tar', 'tar.zst', 'zip-store', 'tar-store'],
         env='COMPRESSION_TYPES'
     )
+    compression_level: int = Field(6, env='COMPRESSION_LEVEL')
+    zstd_level: int = Field(3, env='ZSTD_LEVEL')
+    zstd_workers: int = Field(2, env='ZSTD_WORKERS')
+    compression_skip_extensions: list = Field(
+        ['jpg', 'jpeg', 'png', 'gif', 'webp', 'heic', 'mp3', 'mp4', 'mkv',
+         'mov', 'avi', 'webm', 'zip', 'gz', 'tgz', 'bz2', 'xz', 'zst', '7z',
+         'rar'],
+        env='COMPRESSION_SKIP_EXTENSIONS'
+    )
+    archive_prefetch_workers: int = Field(4, env='ARCHIVE_PREFETCH_WORKERS')
+    archive_prefetch_max_size: int = Field(
+        1024 * 1024, env='ARCHIVE_PREFETCH_MAX_SIZE')
+    auth_cache_ttl: int = Field(60, env='AUTH_CACHE_TTL')
+    auth_cache_max_size: int = Field(10000, env='AUTH_CACHE_MAX_SIZE')
+    auth_cache_redis_enabled: bool = Field(False,
+                                           env='AUTH_CACHE_REDIS_ENABLED')
+    files_list_default_limit: int = Field(100,
+                                          env='FILES_LIST_DEFAULT_LIMIT')
+    files_list_max_limit: int = Field(1000, env='FILES_LIST_MAX_LIMIT')
+    files_info_max_paths: int = Field(1000, env='FILES_INFO_MAX_PATHS')
+    file_cache_ttl: int = Field(6 * 3600, env='FILE_CACHE_TTL')
+    files_list_cache_ttl: int = Field(6 * 3600, env='FILES_LIST_CACHE_TTL')
+    cache_stale_ttl: int = Field(300, env='CACHE_STALE_TTL')
+    cache_negative_ttl: int = Field(10, env='CACHE_NEGATIVE_TTL')
+    replica_cache_ttl: int = Field(5, env='REPLICA_CACHE_TTL')
+    cache_lock_enabled: bool = Field(False, env='CACHE_LOCK_ENABLED')
+    cache_lock_timeout: float = Field(5, env='CACHE_LOCK_TIMEOUT')
+    local_cache_enabled: bool = Field(True, env='LOCAL_CACHE_ENABLED')
+    local_cache_max_size: int = Field(10000, env='LOCAL_CACHE_MAX_SIZE')
+    local_cache_ttl: int = Field(60, env='LOCAL_CACHE_TTL')
+    cache_invalidation_channel: str = Field(
+        'cache_invalidation',
+        env='CACHE_INVALIDATION_CHANNEL'
+    )
+    archive_chunk_size: int = Field(64 * 1024, env='ARCHIVE_CHUNK_SIZE')
+    upload_chunk_size: int = Field(1024 * 1024, env='UPLOAD_CHUNK_SIZE')
+    upload_session_ttl: int = Field(7 * 24 * 3600, env='UPLOAD_SESSION_TTL')
+    upload_cleanup_interval: int = Field(3600,
+                                         env='UPLOAD_CLEANUP_INTERVAL')
+    dedup_enabled: bool = Field(True, env='DEDUP_ENABLED')
+    user_quota_size: Optional[int] = Field(None, env='USER_QUOTA_SIZE')
+    user_quota_files: Optional[int] = Field(None, env='USER_QUOTA_FILES')
+    compression_workers: int = Field(os.cpu_count() or 1,
+                                     env='COMPRESSION_WORKERS')
+    compression_max_concurrent: int = Field(
+        2 * (os.cpu_count() or 1),
+        env='COMPRESSION_MAX_CONCURRENT'
+    )
+    compression_queue_timeout: float = Field(
+        10, env='COMPRESSION_QUEUE_TIMEOUT')
+    compression_retry_after: int = Field(30, env='COMPRESSION_RETRY_AFTER')
+    archive_cache_dir: str = Field(
+        os.path.join(
+            BASE_DIR,
+            'archives'
+        ),
+        env='ARCHIVE_CACHE_DIR'
+    )
+    archive_cache_max_bytes: int = Field(10 * 1024 ** 3,
+                                         env='ARCHIVE_CACHE_MAX_BYTES')
+    archive_job_queue: Literal['redis', 'local'] = Field(
+        'redis',
+        env='ARCHIVE_JOB_QUEUE'
+    )
+    archive_job_workers: int = Field(2, env='ARCHIVE_JOB_WORKERS')
+    archive_job_ttl: int = Field(24 * 3600, env='ARCHIVE_JOB_TTL')
+    archive_job_max_count: int = Field(10000, env='ARCHIVE_JOB_MAX_COUNT')
+    archive_job_cleanup_interval: int = Field(
+        600, env='ARCHIVE_JOB_CLEANUP_INTERVAL')
+    accel_redirect_enabled: bool = Field(False, env='ACCEL_REDIRECT_ENABLED')
+    accel_redirect_files_location: str = Field(
+        '/protected/files/',
+        env='ACCEL_REDIRECT_FILES_LOCATION'
+    )
+    accel_redirect_archives_location: str = Field(
+        '/protected/archives/',
+        env='ACCEL_REDIRECT_ARCHIVES_LOCATION'
+    )
 
     class Config:
         # env_file = '../../.env.sample'
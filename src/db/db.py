@@ -1,15 +1,77 @@
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from fastapi import Depends
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import (AsyncEngine, AsyncSession,
+                                    create_async_engine)
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 from src.core.config import app_settings
 
 Base = declarative_base()
-engine = create_async_engine(app_settings.database_dsn, echo=True, future=True)
+
+
+def create_engine(dsn: str) -> AsyncEngine:
+    connect_args = {}
+    if make_url(dsn).get_driver_name() == 'asyncpg':
+        connect_args['prepared_statement_cache_size'] = (
+            app_settings.database_statement_cache_size)
+    return create_async_engine(
+        dsn,
+        echo=app_settings.database_echo,
+        future=True,
+        pool_size=app_settings.database_pool_size,
+        max_overflow=app_settings.database_max_overflow,
+        pool_timeout=app_settings.database_pool_timeout,
+        pool_recycle=app_settings.database_pool_recycle,
+        pool_pre_ping=app_settings.database_pool_pre_ping,
+        connect_args=connect_args)
+
+
+def get_read_engine() -> AsyncEngine:
+    if app_settings.database_replica_dsn:
+        return create_engine(app_settings.database_replica_dsn)
+    return engine
+
+
+engine = create_engine(app_settings.database_dsn)
+read_engine = get_read_engine()
 async_session = sessionmaker(
     engine, class_=AsyncSession, expire_on_commit=False
 )
+async_read_session = sessionmaker(
+    read_engine, class_=AsyncSession, expire_on_commit=False
+)
 
 
 async def get_session() -> AsyncSession:
     async with async_session() as session:
         yield session
+
+
+async def get_read_session(
+        session: AsyncSession = Depends(get_session)) -> AsyncSession:
+    """
+    Session of read replica, the request session of primary if there is
+    no replica.
+
+    Only for queries which tolerate lag of a replica, results read from
+    it are cached for get_cache_ttl.
+    """
+    if read_engine is engine:
+        yield session
+        return
+    async with async_read_session() as read_session:
+        yield read_session
+
+
+def is_read_replica(session: AsyncSession) -> bool:
+    return read_engine is not engine and session.bind is read_engine
+
+
+def get_cache_ttl(session: AsyncSession, ttl: int) -> int:
+    """
+    Cache time of results read with session, results of a replica may
+    lag behind writes and are kept for replica_cache_ttl at most.
+    """
+    if is_read_replica(session):
+        return min(ttl, app_settings.replica_cache_ttl)
+    return ttl
@@ -25,7 +25,7 @@ if config.config_file_name is not None:
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
 from src.db.db import Base
-from src.models.models import Directory, File, User
+from src.models.models import Blob, Directory, File, UploadSession, User
 
 target_metadata = Base.metadata
 
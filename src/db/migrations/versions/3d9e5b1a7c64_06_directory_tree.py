@@ -0,0 +1,94 @@
+"""06_directory-tree
+
+Revision ID: 3d9e5b1a7c64
+Revises: 7f3b2a6c0e91
+Create Date: 2026-10-18 15:21:08.514372
+
+"""
+import os
+import uuid
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy_utils import UUIDType
+
+# revision identifiers, used by Alembic.
+revision = '3d9e5b1a7c64'
+down_revision = '7f3b2a6c0e91'
+branch_labels = None
+depends_on = None
+
+DIRECTORY_NAMESPACE = uuid.UUID('6f1c9a52-3b8e-4d07-9a4e-2c5d8b7e1f30')
+
+
+def get_dir_id(user_id, dir_path):
+    return uuid.uuid5(DIRECTORY_NAMESPACE, f'{user_id}:{dir_path}')
+
+
+def fill_directories():
+    """
+    Rebuild folders of stored files, a folder belongs to a user and its
+    id is derived from the user and the path. Folders without files have
+    no owner and are dropped.
+    """
+    connection = op.get_bind()
+    directories = {}
+    files = connection.execute(sa.text(
+        'SELECT path, user_id, size, created_at FROM files '
+        'ORDER BY created_at'))
+    for path, user_id, size, created_at in files:
+        dir_path = os.path.dirname(path)
+        while dir_path != '/':
+            parent_path = os.path.dirname(dir_path)
+            directory = directories.setdefault((str(user_id), dir_path), {
+                'id': get_dir_id(user_id, dir_path),
+                'parent_id': (get_dir_id(user_id, parent_path)
+                              if parent_path != '/' else None),
+                'path': dir_path, 'user_id': user_id, 'file_count': 0,
+                'total_size': 0, 'last_modified': None})
+            directory['file_count'] += 1
+            directory['total_size'] += size
+            directory['last_modified'] = created_at
+            dir_path = parent_path
+    connection.execute(sa.text('DELETE FROM directories'))
+    if not directories:
+        return
+    table = sa.table('directories',
+                     sa.column('id', UUIDType(binary=False)),
+                     sa.column('path', sa.String()),
+                     sa.column('parent_id', UUIDType(binary=False)),
+                     sa.column('user_id', UUIDType()),
+                     sa.column('file_count', sa.BigInteger()),
+                     sa.column('total_size', sa.BigInteger()),
+                     sa.column('last_modified', sa.DateTime()))
+    op.bulk_insert(table, list(directories.values()))
+
+
+def upgrade() -> None:
+    op.add_column('directories', sa.Column('parent_id', UUIDType(binary=False), nullable=True))
+    op.add_column('directories', sa.Column('user_id', UUIDType(), nullable=True))
+    op.add_column('directories', sa.Column('file_count', sa.BigInteger(), server_default='0', nullable=False))
+    op.add_column('directories', sa.Column('total_size', sa.BigInteger(), server_default='0', nullable=False))
+    op.add_column('directories', sa.Column('last_modified', sa.DateTime(), nullable=True))
+    fill_directories()
+    op.alter_column('directories', 'user_id', existing_type=UUIDType(), nullable=False)
+    op.drop_constraint('directories_path_key', 'directories', type_='unique')
+    op.create_index('ix_directories_user_id_path', 'directories', ['user_id', 'path'], unique=True)
+    op.create_foreign_key('directories_parent_id_fkey', 'directories', 'directories', ['parent_id'], ['id'], ondelete='CASCADE')
+    op.create_foreign_key('directories_user_id_fkey', 'directories', 'users', ['user_id'], ['id'], ondelete='CASCADE')
+    op.create_index('ix_directories_parent_id_path', 'directories', ['parent_id', 'path'], unique=False)
+    op.create_index('ix_directories_user_id_parent_id', 'directories', ['user_id', 'parent_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_directories_user_id_path', table_name='directories')
+    op.create_unique_constraint('directories_path_key', 'directories', ['path'])
+    op.drop_index('ix_directories_user_id_parent_id', table_name='directories')
+    op.drop_index('ix_directories_parent_id_path', table_name='directories')
+    op.drop_constraint('directories_user_id_fkey', 'directories', type_='foreignkey')
+    op.drop_constraint('directories_parent_id_fkey', 'directories', type_='foreignkey')
+    op.drop_column('directories', 'last_modified')
+    op.drop_column('directories', 'total_size')
+    op.drop_column('directories', 'file_count')
+    op.drop_column('directories', 'user_id')
+    op.drop_column('directories', 'parent_id')
@@ -0,0 +1,23 @@
+"""05_storage-path
+
+Revision ID: 7f3b2a6c0e91
+Revises: e4a7c93b1d58
+Create Date: 2026-10-18 13:05:44.730218
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '7f3b2a6c0e91'
+down_revision = 'e4a7c93b1d58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('files', sa.Column('storage_path', sa.String(length=255), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('files', 'storage_path')
@@ -0,0 +1,27 @@
+"""07_files-search-indexes
+
+Revision ID: a52c7e8d4f19
+Revises: 3d9e5b1a7c64
+Create Date: 2026-10-18 16:02:51.183904
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'a52c7e8d4f19'
+down_revision = '3d9e5b1a7c64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_files_user_id_path_pattern', 'files', ['user_id', 'path'], unique=False, postgresql_ops={'path': 'text_pattern_ops'})
+    op.create_index('ix_files_name_trgm', 'files', ['name'], unique=False, postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_files_path_trgm', 'files', ['path'], unique=False, postgresql_using='gin', postgresql_ops={'path': 'gin_trgm_ops'})
+
+
+def downgrade() -> None:
+    op.drop_index('ix_files_path_trgm', table_name='files')
+    op.drop_index('ix_files_name_trgm', table_name='files')
+    op.drop_index('ix_files_user_id_path_pattern', table_name='files')
@@ -0,0 +1,35 @@
+"""03_blobs
+
+Revision ID: b81d6e0f3c25
+Revises: 5c2f8d1e9a47
+Create Date: 2026-10-18 11:02:17.204615
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'b81d6e0f3c25'
+down_revision = '5c2f8d1e9a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('blobs',
+    sa.Column('hash', sa.String(length=64), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=False),
+    sa.Column('ref_count', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('hash')
+    )
+    op.add_column('files', sa.Column('blob_hash', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_files_blob_hash'), 'files', ['blob_hash'], unique=False)
+    op.create_foreign_key('files_blob_hash_fkey', 'files', 'blobs', ['blob_hash'], ['hash'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('files_blob_hash_fkey', 'files', type_='foreignkey')
+    op.drop_index(op.f('ix_files_blob_hash'), table_name='files')
+    op.drop_column('files', 'blob_hash')
+    op.drop_table('blobs')
@@ -0,0 +1,35 @@
+"""08_user-usage
+
+Revision ID: c17b4f9e2d83
+Revises: a52c7e8d4f19
+Create Date: 2026-10-18 16:47:30.629154
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c17b4f9e2d83'
+down_revision = 'a52c7e8d4f19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('used_size', sa.BigInteger(), server_default='0', nullable=False))
+    op.add_column('users', sa.Column('file_count', sa.BigInteger(), server_default='0', nullable=False))
+    op.add_column('users', sa.Column('quota_size', sa.BigInteger(), nullable=True))
+    op.add_column('users', sa.Column('quota_files', sa.BigInteger(), nullable=True))
+    op.execute(
+        'UPDATE users SET used_size = usage.used_size, '
+        'file_count = usage.file_count '
+        'FROM (SELECT user_id, sum(size) AS used_size, '
+        'count(*) AS file_count FROM files GROUP BY user_id) AS usage '
+        'WHERE users.id = usage.user_id')
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'quota_files')
+    op.drop_column('users', 'quota_size')
+    op.drop_column('users', 'file_count')
+    op.drop_column('users', 'used_size')
@@ -0,0 +1,26 @@
+"""04_files-list-indexes
+
+Revision ID: e4a7c93b1d58
+Revises: b81d6e0f3c25
+Create Date: 2026-10-18 12:20:36.118904
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e4a7c93b1d58'
+down_revision = 'b81d6e0f3c25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_files_user_id_path', 'files', ['user_id', 'path'], unique=False)
+    op.create_index('ix_files_user_id_created_at', 'files', ['user_id', 'created_at', 'id'], unique=False)
+    op.drop_index('ix_files_user_id', table_name='files')
+
+
+def downgrade() -> None:
+    op.create_index('ix_files_user_id', 'files', ['user_id'], unique=False)
+    op.drop_index('ix_files_user_id_created_at', table_name='files')
+    op.drop_index('ix_files_user_id_path', table_name='files')
@@ -4,9 +4,15 @@ from fastapi.responses import ORJSONResponse
 from fastapi_cache import caches, close_caches
 from fastapi_cache.backends.redis import CACHE_KEY, RedisCacheBackend
 
+from src.api.v1.archives import router as archives_router
 from src.api.v1.auth import router as auth_router
 from src.api.v1.base import router as base_router
+from src.api.v1.uploads import router as uploads_router
 from src.core.config import app_settings
+from src.services.archive_jobs import archive_worker
+from src.services.base import upload_sweeper
+from src.services.cache import local_cache
+from src.services.pool import compression_pool
 
 app = FastAPI(
     title=app_settings.app_title,
@@ -17,17 +23,27 @@ app = FastAPI(
 
 app.include_router(base_router, prefix="/api/v1")
 app.include_router(auth_router, prefix="/api/v1")
+app.include_router(uploads_router, prefix="/api/v1")
+app.include_router(archives_router, prefix="/api/v1")
 
 
 @app.on_event('startup')
 async def on_startup() -> None:
     rc = RedisCacheBackend(app_settings.redis_url)
     caches.set(CACHE_KEY, rc)
+    local_cache.start(app_settings.redis_url)
+    compression_pool.start()
+    archive_worker.start()
+    upload_sweeper.start()
 
 
 @app.on_event('shutdown')
 async def on_shutdown() -> None:
+    await local_cache.stop()
+    await archive_worker.stop()
+    await upload_sweeper.stop()
     await close_caches()
+    compression_pool.shutdown()
 
 if __name__ == '__main__':
     uvicorn.run(
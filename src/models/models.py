@@ -1,7 +1,8 @@
 import uuid
 from datetime import datetime
 
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import (BigInteger, Boolean, Column, DateTime, ForeignKey,
+                        Index, Integer, String)
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils import UUIDType
 
@@ -15,22 +16,72 @@ class User(Base):
     password = Column(String(125), nullable=False)
     files = relationship('File', back_populates="user", passive_deletes=True)
     created_at = Column(DateTime, index=True, default=datetime.utcnow)
+    used_size = Column(BigInteger, nullable=False, default=0)
+    file_count = Column(BigInteger, nullable=False, default=0)
+    quota_size = Column(BigInteger)
+    quota_files = Column(BigInteger)
 
 
 class File(Base):
     __tablename__ = 'files'
+    __table_args__ = (
+        Index('ix_files_user_id_path', 'user_id', 'path'),
+        Index('ix_files_user_id_created_at', 'user_id', 'created_at', 'id'),
+        Index('ix_files_user_id_path_pattern', 'user_id', 'path',
+              postgresql_ops={'path': 'text_pattern_ops'}),
+        Index('ix_files_name_trgm', 'name',
+              postgresql_using='gin',
+              postgresql_ops={'name': 'gin_trgm_ops'}),
+        Index('ix_files_path_trgm', 'path',
+              postgresql_using='gin',
+              postgresql_ops={'path': 'gin_trgm_ops'}),
+    )
     id = Column(UUIDType(binary=False), primary_key=True, default=uuid.uuid1)
     user_id = Column(UUIDType, ForeignKey('users.id', ondelete="CASCADE"),
-                     nullable=False, index=True)
+                     nullable=False)
     user = relationship("User", back_populates="files")
     name = Column(String(125), nullable=False)
     created_at = Column(DateTime, index=True, default=datetime.utcnow)
     path = Column(String(255), nullable=False, unique=True)
-    size = Column(Integer, nullable=False)
+    storage_path = Column(String(255))
+    size = Column(BigInteger, nullable=False)
     is_downloadable = Column(Boolean, default=False)
+    blob_hash = Column(String(64), ForeignKey('blobs.hash'), index=True)
+
+
+class Blob(Base):
+    __tablename__ = 'blobs'
+    hash = Column(String(64), primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
 
 
 class Directory(Base):
     __tablename__ = 'directories'
+    __table_args__ = (
+        Index('ix_directories_parent_id_path', 'parent_id', 'path'),
+        Index('ix_directories_user_id_parent_id', 'user_id', 'parent_id'),
+        Index('ix_directories_user_id_path', 'user_id', 'path',
+              unique=True),
+    )
     id = Column(UUIDType(binary=False), primary_key=True, default=uuid.uuid1)
-    path = Column(String(255), nullable=False, unique=True)
+    path = Column(String(255), nullable=False)
+    parent_id = Column(UUIDType(binary=False),
+                       ForeignKey('directories.id', ondelete="CASCADE"))
+    user_id = Column(UUIDType, ForeignKey('users.id', ondelete="CASCADE"),
+                     nullable=False)
+    file_count = Column(BigInteger, nullable=False, default=0)
+    total_size = Column(BigInteger, nullable=False, default=0)
+    last_modified = Column(DateTime)
+
+
+class UploadSession(Base):
+    __tablename__ = 'upload_sessions'
+    id = Column(UUIDType(binary=False), primary_key=True, default=uuid.uuid1)
+    user_id = Column(UUIDType, ForeignKey('users.id', ondelete="CASCADE"),
+                     nullable=False, index=True)
+    path = Column(String(255), nullable=False)
+    size = Column(BigInteger, nullable=False)
+    offset = Column(BigInteger, nullable=False, default=0)
+    created_at = Column(DateTime, index=True, default=datetime.utcnow)
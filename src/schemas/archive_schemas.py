@@ -0,0 +1,17 @@
+from datetime import datetime
+from typing import Literal, Optional
+from uuid import UUID
+
+from pydantic import BaseModel
+
+
+class ArchiveJob(BaseModel):
+    id: UUID
+    path: str
+    compression_type: str
+    status: Literal['queued', 'running', 'done', 'failed']
+    progress: float
+    total_size: int
+    size: Optional[int] = None
+    error: Optional[str] = None
+    created_at: datetime
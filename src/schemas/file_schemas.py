@@ -1,8 +1,10 @@
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 from uuid import UUID
 
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, conlist, validator
+
+from src.core.config import app_settings
 
 
 class FileBase(BaseModel):
@@ -18,6 +20,7 @@ class FileBase(BaseModel):
 
 
 class File(FileBase):
+    storage_path: Optional[str] = None
 
     @validator('created_at', pre=True)
     def datetime_to_str(cls, value):
@@ -40,7 +43,38 @@ class FileInDB(FileBase):
 class FilesList(BaseModel):
     account_id: UUID
     files: List
+    next_cursor: Optional[str] = None
+
+
+class FilesInfoRequest(BaseModel):
+    paths: conlist(str,
+                   min_items=1,
+                   max_items=app_settings.files_info_max_paths)
+
+
+class FilesInfo(BaseModel):
+    files: List[FileBase]
+    not_found: List[str]
+
+
+class Folder(BaseModel):
+    id: UUID
+    path: str
+    file_count: int
+    total_size: int
+    last_modified: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
+
+
+class FolderInfo(BaseModel):
+    folder: Optional[Folder] = None
+    folders: List[Folder]
 
 
 class PathSchema(BaseModel):
     path: str
+
+    class Config:
+        orm_mode = True
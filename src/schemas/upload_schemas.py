@@ -0,0 +1,15 @@
+from datetime import datetime
+from uuid import UUID
+
+from pydantic import BaseModel
+
+
+class UploadSession(BaseModel):
+    id: UUID
+    path: str
+    size: int
+    offset: int
+    created_at: datetime
+
+    class Config:
+        orm_mode = True
@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import Optional
 from uuid import UUID
 
 from pydantic import BaseModel, validator
@@ -32,7 +33,18 @@ class CurrentUser(User):
     id: UUID
     created_at: datetime
 
+    class Config:
+        orm_mode = True
+
     @validator('created_at', pre=True)
     def datetime_to_str(cls, value):
         if isinstance(value, str):
             return datetime.fromisoformat(value)
+        return value
+
+
+class Usage(BaseModel):
+    used_size: int
+    file_count: int
+    quota_size: Optional[int] = None
+    quota_files: Optional[int] = None
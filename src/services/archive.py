@@ -0,0 +1,374 @@
+import collections
+import functools
+import hashlib
+import io
+import itertools
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import (BinaryIO, Callable, Collection, Iterable, Iterator,
+                    NamedTuple, Tuple)
+
+import py7zr
+import pyzstd
+
+from src.core.config import app_settings
+from src.services.storage import storage
+
+MEDIA_TYPES = {
+    'zip': 'application/x-zip-compressed',
+    'tar': 'application/x-gtar',
+    '7z': 'application/x-7z-compressed',
+    'tar.zst': 'application/zstd',
+    'zip-store': 'application/x-zip-compressed',
+    'tar-store': 'application/x-tar',
+}
+FILE_EXTENSIONS = {
+    'zip-store': 'zip',
+    'tar-store': 'tar',
+}
+STREAMABLE_TYPES = ('zip', 'tar', 'tar.zst', 'zip-store', 'tar-store')
+# zstd has no level without compression, negative levels are the fastest
+ZSTD_STORE_LEVEL = -7
+
+
+def get_file_extension(compression_type: str) -> str:
+    return FILE_EXTENSIONS.get(compression_type, compression_type)
+
+
+class StreamBuffer(io.RawIOBase):
+    """
+    Write-only sink which keeps archive bytes until they are sent.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def pop(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ArchiveMember(NamedTuple):
+    """
+    File of an archive, source is a storage key or a local path.
+    """
+    source: str
+    arcname: str
+    size: int
+    mtime: float
+
+
+def walk_files(full_path: str,
+               exclude: Collection[str] = ()) -> Iterator[os.DirEntry]:
+    """
+    Yield files of a folder and of all its subfolders but excluded ones.
+    """
+    folders = [full_path]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path not in exclude:
+                        folders.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+
+def get_archive_members(full_path: str,
+                        exclude: Collection[str] = ()) -> list:
+    """
+    Return archive members of a file or a folder on local disk, names
+    in archive are relative to the folder.
+    """
+    if os.path.isfile(full_path):
+        stat_result = os.stat(full_path)
+        return [ArchiveMember(source=full_path,
+                              arcname=os.path.basename(full_path),
+                              size=stat_result.st_size,
+                              mtime=stat_result.st_mtime)]
+    members = []
+    for entry in walk_files(full_path, exclude):
+        stat_result = entry.stat()
+        arcname = os.path.relpath(entry.path, full_path)
+        members.append(ArchiveMember(source=entry.path,
+                                     arcname=arcname.replace(os.sep, '/'),
+                                     size=stat_result.st_size,
+                                     mtime=stat_result.st_mtime))
+    return sorted(members, key=lambda member: member.arcname)
+
+
+def get_fingerprint(members: list) -> str:
+    """
+    Hash of member names, sizes and mtimes of an archive.
+    """
+    fingerprint = hashlib.sha256()
+    for member in members:
+        fingerprint.update(
+            f'{member.arcname}\0{member.size}\0{member.mtime!r}\0'.encode())
+    return fingerprint.hexdigest()
+
+
+def is_compressible(arcname: str) -> bool:
+    """
+    Media and archives are compressed already, deflate only wastes time
+    on them.
+    """
+    extension = os.path.splitext(arcname)[1].lstrip('.').lower()
+    return extension not in app_settings.compression_skip_extensions
+
+
+def _read_chunks(source: str, size: int) -> Iterator[bytes]:
+    chunk_size = app_settings.archive_chunk_size
+    with storage.open_sync(source) as src:
+        while size > 0:
+            chunk = src.read(min(chunk_size, size))
+            if not chunk:
+                break
+            size -= len(chunk)
+            yield chunk
+    if size > 0:
+        # file was truncated while reading, keep the declared size
+        yield tarfile.NUL * size
+
+
+def _read_member(member: ArchiveMember) -> bytes:
+    return b''.join(_read_chunks(member.source, member.size))
+
+
+def iter_member_contents(
+        members: list) -> Iterator[Tuple[ArchiveMember, Iterable[bytes]]]:
+    """
+    Yield members with their content in archive order.
+
+    Small files are read ahead by a thread pool, so reading of the next
+    files overlaps with compression of the current one. Big files are
+    read chunk by chunk when their turn comes.
+    """
+    workers = app_settings.archive_prefetch_workers
+    max_size = app_settings.archive_prefetch_max_size
+    if workers <= 0:
+        for member in members:
+            yield member, _read_chunks(member.source, member.size)
+        return
+    members_iterator = iter(members)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while len(pending) < 2 * workers:
+                member = next(members_iterator, None)
+                if member is None:
+                    break
+                future = None
+                if member.size <= max_size:
+                    future = executor.submit(_read_member, member)
+                pending.append((member, future))
+            if not pending:
+                break
+            member, future = pending.popleft()
+            if future is None:
+                yield member, _read_chunks(member.source, member.size)
+            else:
+                yield member, (future.result(),)
+
+
+def iter_zip(members: list, store: bool = False) -> Iterator[bytes]:
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, mode='w',
+                         compression=zipfile.ZIP_DEFLATED) as zip_io:
+        for member, chunks in iter_member_contents(members):
+            zip_info = zipfile.ZipInfo(
+                member.arcname, time.localtime(member.mtime)[:6])
+            zip_info.external_attr = (stat.S_IFREG | 0o644) << 16
+            zip_info.file_size = member.size
+            if not store and is_compressible(member.arcname):
+                zip_info.compress_type = zipfile.ZIP_DEFLATED
+                # ZipFile.open takes the level only from ZipInfo
+                zip_info._compresslevel = app_settings.compression_level
+            else:
+                zip_info.compress_type = zipfile.ZIP_STORED
+            with zip_io.open(zip_info, mode='w') as dest:
+                for chunk in chunks:
+                    dest.write(chunk)
+                    data = buffer.pop()
+                    if data:
+                        yield data
+    yield buffer.pop()
+
+
+def iter_tar_entries(
+        members: list) -> Iterator[Tuple[bool, Iterable[bytes]]]:
+    """
+    Yield uncompressed tar stream by entries, the same as tarfile writes
+    it, with a flag if an entry is worth compressing.
+    """
+    written = 0
+    for member, chunks in iter_member_contents(members):
+        tar_info = tarfile.TarInfo(member.arcname)
+        tar_info.size = member.size
+        tar_info.mtime = int(member.mtime)
+        header = tar_info.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING,
+                                'surrogateescape')
+        padding = -tar_info.size % tarfile.BLOCKSIZE
+        yield is_compressible(member.arcname), itertools.chain(
+            (header,), chunks, (tarfile.NUL * padding,))
+        written += len(header) + tar_info.size + padding
+    end_of_archive = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+    written += len(end_of_archive)
+    yield True, (
+        end_of_archive + tarfile.NUL * (-written % tarfile.RECORDSIZE),)
+
+
+class ZstdFrameCompressor:
+    """
+    zstd frames with the interface of zlib compress objects, a frame is
+    ended by flush and the next one is started by the same compressor.
+    """
+
+    def __init__(self, level: int, workers: int):
+        self._compressor = pyzstd.ZstdCompressor({
+            pyzstd.CParameter.compressionLevel: level,
+            pyzstd.CParameter.nbWorkers: workers,
+        })
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(pyzstd.ZstdCompressor.FLUSH_FRAME)
+
+
+def get_gzip_compressor(compressible: bool):
+    level = app_settings.compression_level if compressible else 0
+    return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+
+def get_zstd_compressor(compressible: bool) -> ZstdFrameCompressor:
+    if compressible:
+        return ZstdFrameCompressor(app_settings.zstd_level,
+                                   app_settings.zstd_workers)
+    # the fastest level gains nothing from worker threads
+    return ZstdFrameCompressor(ZSTD_STORE_LEVEL, 0)
+
+
+def iter_compressed_tar(members: list,
+                        get_compressor: Callable) -> Iterator[bytes]:
+    """
+    Entries which are not compressible go to separate gzip members or
+    zstd frames with the fastest level, readers join them into one
+    stream.
+    """
+    compressor = None
+    is_compressor_for = None
+    for compressible, blocks in iter_tar_entries(members):
+        if compressible != is_compressor_for:
+            if compressor is not None:
+                yield compressor.flush()
+            compressor = get_compressor(compressible)
+            is_compressor_for = compressible
+        for block in blocks:
+            data = compressor.compress(block)
+            if data:
+                yield data
+    yield compressor.flush()
+
+
+def iter_tar(members: list) -> Iterator[bytes]:
+    # gzip container, the same format as tarfile mode 'w:gz'
+    return iter_compressed_tar(members, get_gzip_compressor)
+
+
+def iter_tar_zst(members: list) -> Iterator[bytes]:
+    # compressors with their worker threads are reused for the whole
+    # archive, one per level
+    compressors = {}
+
+    def get_compressor(compressible: bool) -> ZstdFrameCompressor:
+        if compressible not in compressors:
+            compressors[compressible] = get_zstd_compressor(compressible)
+        return compressors[compressible]
+
+    return iter_compressed_tar(members, get_compressor)
+
+
+def iter_tar_store(members: list) -> Iterator[bytes]:
+    for _, blocks in iter_tar_entries(members):
+        for block in blocks:
+            if block:
+                yield block
+
+
+ARCHIVE_ITERATORS = {
+    'zip': iter_zip,
+    'zip-store': functools.partial(iter_zip, store=True),
+    'tar': iter_tar,
+    'tar.zst': iter_tar_zst,
+    'tar-store': iter_tar_store,
+}
+
+
+def _write_7z_member(seven_zip: py7zr.SevenZipFile,
+                     member: ArchiveMember) -> None:
+    local_path = storage.get_local_path(member.source)
+    if local_path is not None:
+        seven_zip.write(local_path, member.arcname)
+        return
+    # py7zr needs a seekable file, remote content is spooled to disk
+    with tempfile.TemporaryFile() as spool:
+        with storage.open_sync(member.source) as src:
+            shutil.copyfileobj(src, spool, app_settings.archive_chunk_size)
+        spool.seek(0)
+        seven_zip.writef(spool, member.arcname)
+
+
+def compress(file_obj: BinaryIO,
+             members: list,
+             compression_type: str) -> None:
+    """
+    Write the whole archive of members into file_obj.
+    """
+    if compression_type == '7z':
+        filters = [{'id': py7zr.FILTER_LZMA2,
+                    'preset': app_settings.compression_level}]
+        if not any(is_compressible(member.arcname) for member in members):
+            filters = [{'id': py7zr.FILTER_COPY}]
+        with py7zr.SevenZipFile(file_obj, mode='w',
+                                filters=filters) as seven_zip:
+            for member in members:
+                _write_7z_member(seven_zip, member)
+        return
+    for chunk in ARCHIVE_ITERATORS[compression_type](members):
+        file_obj.write(chunk)
+        file_obj.flush()
+
+
+def compress_to_file(archive_path: str,
+                     members: list,
+                     compression_type: str) -> None:
+    """
+    Entry point for compression pool workers.
+
+    zip and tar are flushed chunk by chunk, so the archive can be sent
+    while it is still being written.
+    """
+    with open(archive_path, 'wb') as file_obj:
+        compress(file_obj, members, compression_type)
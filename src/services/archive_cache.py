@@ -0,0 +1,125 @@
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from typing import Optional
+
+from src.core.config import app_settings
+
+logger = logging.getLogger(__name__)
+
+TEMP_SUFFIX = '.tmp'
+
+
+def normalize_path(path: str) -> str:
+    return path.rstrip('/') or '/'
+
+
+def get_parent_paths(path: str) -> list:
+    """
+    Return path and all its parent folders: /a/b -> ['/', '/a', '/a/b'].
+    """
+    parts = normalize_path(path).split('/')[1:]
+    paths = ['/']
+    for index in range(len(parts)):
+        if parts[index]:
+            paths.append('/' + '/'.join(parts[:index + 1]))
+    return paths
+
+
+class ArchiveCache:
+    """
+    On-disk cache of built archives with LRU eviction by total size.
+
+    Entries are stored as <cache_dir>/<hash of path>/<fingerprint>.<type>,
+    so all archives of one path can be dropped at once. Access time is
+    kept in the file mtime.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+
+    def _get_path_dir(self, path: str) -> str:
+        path_hash = hashlib.sha256(normalize_path(path).encode()).hexdigest()
+        return os.path.join(self._cache_dir, path_hash)
+
+    def get_entry_path(self,
+                       path: str,
+                       compression_type: str,
+                       fingerprint: str) -> str:
+        return os.path.join(self._get_path_dir(path),
+                            f'{fingerprint}.{compression_type}')
+
+    def get(self,
+            path: str,
+            compression_type: str,
+            fingerprint: str) -> Optional[str]:
+        entry_path = self.get_entry_path(path, compression_type, fingerprint)
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return None
+        return entry_path
+
+    def reserve(self, path: str) -> str:
+        """
+        Create a temporary file for a new entry of path.
+        """
+        path_dir = self._get_path_dir(path)
+        os.makedirs(path_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=path_dir, suffix=TEMP_SUFFIX)
+        os.close(fd)
+        return temp_path
+
+    def discard(self, temp_path: str) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+
+    def commit(self, temp_path: str, entry_path: str) -> None:
+        try:
+            os.replace(temp_path, entry_path)
+        except FileNotFoundError:
+            # path was invalidated while the archive was built
+            return
+        loop = asyncio.get_running_loop()
+        loop.run_in_executor(None, self.evict)
+
+    def invalidate(self, path: str) -> None:
+        """
+        Drop archives of path and of every folder containing it.
+        """
+        for parent_path in get_parent_paths(path):
+            shutil.rmtree(self._get_path_dir(parent_path), ignore_errors=True)
+
+    def evict(self) -> None:
+        entries = []
+        total_bytes = 0
+        with contextlib.suppress(FileNotFoundError):
+            for path_dir in os.scandir(self._cache_dir):
+                if not path_dir.is_dir():
+                    continue
+                for entry in os.scandir(path_dir.path):
+                    if entry.name.endswith(TEMP_SUFFIX):
+                        continue
+                    with contextlib.suppress(FileNotFoundError):
+                        stat = entry.stat()
+                        entries.append(
+                            (stat.st_mtime, stat.st_size, entry.path))
+                        total_bytes += stat.st_size
+        if total_bytes <= self._max_bytes:
+            return
+        for _, size, entry_path in sorted(entries):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry_path)
+            logger.info('Evict archive %s from cache', entry_path)
+            total_bytes -= size
+            if total_bytes <= self._max_bytes:
+                break
+
+
+archive_cache = ArchiveCache(cache_dir=app_settings.archive_cache_dir,
+                             max_bytes=app_settings.archive_cache_max_bytes)
@@ -0,0 +1,455 @@
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+import aioredis
+import orjson
+from aioredis import Redis
+from fastapi import HTTPException
+from fastapi_cache.backends.redis import RedisCacheBackend
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette import status
+from starlette.concurrency import run_in_threadpool
+
+from src.core.config import app_settings
+from src.db.db import async_session
+from src.models.models import User
+from src.services.archive import compress_to_file, get_fingerprint
+from src.services.cache import LRUCache
+from src.services.pool import compression_pool
+from src.services.storage import ARCHIVES_FOLDER, remove_stale_files, storage
+from src.services.utils import resolve_archive_members, resolve_archive_path
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = 'archive_jobs_queue'
+RUNNING_KEY = 'archive_jobs_running'
+BUILDS_FOLDER = '.jobs'
+POP_TIMEOUT = 5
+PROGRESS_INTERVAL = 1
+HEARTBEAT_TIMEOUT = 120
+
+
+def get_job_key(job_id: str) -> str:
+    return f'archive_job_{job_id}'
+
+
+def get_archive_key(job: dict) -> str:
+    """
+    Storage key of a finished archive.
+    """
+    return f'{ARCHIVES_FOLDER}/{job["id"]}.{job["compression_type"]}'
+
+
+def get_builds_path() -> str:
+    return os.path.join(app_settings.archive_cache_dir, BUILDS_FOLDER)
+
+
+def create_build_file() -> str:
+    """
+    Create a file to build an archive of a job in.
+
+    Builds are kept apart from archive cache entries, which are removed
+    when files of their path change.
+    """
+    builds_path = get_builds_path()
+    os.makedirs(builds_path, exist_ok=True)
+    fd, build_path = tempfile.mkstemp(dir=builds_path, suffix='.tmp')
+    os.close(fd)
+    return build_path
+
+
+def remove_build_file(build_path: str) -> None:
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(build_path)
+
+
+class JobQueue:
+    """
+    Archive jobs kept for archive_job_ttl and a queue of their ids.
+
+    An identical request of the same user gets the job which is already
+    queued, running or done.
+    """
+
+    async def get_value(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    async def set_value(self,
+                        key: str,
+                        value: bytes,
+                        only_new: bool = False) -> bool:
+        raise NotImplementedError
+
+    async def delete_value(self, key: str) -> None:
+        raise NotImplementedError
+
+    async def push(self, job_id: str) -> None:
+        raise NotImplementedError
+
+    async def pop(self) -> Optional[str]:
+        """
+        Wait up to POP_TIMEOUT for a job id.
+        """
+        raise NotImplementedError
+
+    async def add_running(self, job_id: str) -> None:
+        raise NotImplementedError
+
+    async def remove_running(self, job_id: str) -> None:
+        raise NotImplementedError
+
+    async def get_running(self) -> List[str]:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+    async def get_job(self, job_id: str) -> Optional[dict]:
+        value = await self.get_value(get_job_key(job_id))
+        return orjson.loads(value) if value else None
+
+    async def save_job(self, job: dict) -> None:
+        await self.set_value(get_job_key(job['id']), orjson.dumps(job))
+
+    async def add_job(self, job: dict) -> dict:
+        """
+        Queue job, return an identical job instead if there is one.
+        """
+        dedup_key = job['dedup_key']
+        job_id = job['id'].encode()
+        while not await self.set_value(dedup_key, job_id, only_new=True):
+            existing_id = await self.get_value(dedup_key)
+            if existing_id is None:
+                # the key has expired meanwhile, it is taken again
+                continue
+            existing_job = await self.get_job(existing_id.decode())
+            if existing_job is not None:
+                return existing_job
+            await self.set_value(dedup_key, job_id)
+            break
+        await self.save_job(job)
+        await self.push(job['id'])
+        return job
+
+    async def fail_job(self, job: dict, error: str) -> None:
+        job.update(status='failed', error=error)
+        await self.save_job(job)
+        await self.delete_value(job['dedup_key'])
+
+
+class RedisJobQueue(JobQueue):
+    def __init__(self, redis_url: str):
+        self._redis_url = redis_url
+        self._redis: Optional[Redis] = None
+
+    async def _get_redis(self) -> Redis:
+        if self._redis is None:
+            redis = await aioredis.create_redis_pool(self._redis_url)
+            if self._redis is None:
+                self._redis = redis
+            else:
+                # created by a concurrent call
+                redis.close()
+        return self._redis
+
+    async def get_value(self, key: str) -> Optional[bytes]:
+        redis = await self._get_redis()
+        return await redis.get(key)
+
+    async def set_value(self,
+                        key: str,
+                        value: bytes,
+                        only_new: bool = False) -> bool:
+        redis = await self._get_redis()
+        kwargs = {'exist': Redis.SET_IF_NOT_EXIST} if only_new else {}
+        return bool(await redis.set(key,
+                                    value,
+                                    expire=app_settings.archive_job_ttl,
+                                    **kwargs))
+
+    async def delete_value(self, key: str) -> None:
+        redis = await self._get_redis()
+        await redis.delete(key)
+
+    async def push(self, job_id: str) -> None:
+        redis = await self._get_redis()
+        await redis.rpush(QUEUE_KEY, job_id)
+
+    async def pop(self) -> Optional[str]:
+        redis = await self._get_redis()
+        item = await redis.blpop(QUEUE_KEY, timeout=POP_TIMEOUT)
+        return item[1].decode() if item else None
+
+    async def add_running(self, job_id: str) -> None:
+        redis = await self._get_redis()
+        await redis.sadd(RUNNING_KEY, job_id)
+
+    async def remove_running(self, job_id: str) -> None:
+        redis = await self._get_redis()
+        await redis.srem(RUNNING_KEY, job_id)
+
+    async def get_running(self) -> List[str]:
+        redis = await self._get_redis()
+        return await redis.smembers(RUNNING_KEY, encoding='utf-8')
+
+    async def close(self) -> None:
+        if self._redis is not None:
+            self._redis.close()
+            await self._redis.wait_closed()
+            self._redis = None
+
+
+class LocalJobQueue(JobQueue):
+    """
+    In-process queue, jobs are seen by this worker only.
+    """
+
+    def __init__(self):
+        self._values = LRUCache(max_size=app_settings.archive_job_max_count)
+        self._queue: Optional[asyncio.Queue] = None
+        self._running = set()
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def get_value(self, key: str) -> Optional[bytes]:
+        return self._values.get(key)
+
+    async def set_value(self,
+                        key: str,
+                        value: bytes,
+                        only_new: bool = False) -> bool:
+        if only_new and self._values.get(key) is not None:
+            return False
+        self._values.set(key, value, ttl=app_settings.archive_job_ttl)
+        return True
+
+    async def delete_value(self, key: str) -> None:
+        self._values.delete(key)
+
+    async def push(self, job_id: str) -> None:
+        self.queue.put_nowait(job_id)
+
+    async def pop(self) -> Optional[str]:
+        with contextlib.suppress(asyncio.TimeoutError):
+            return await asyncio.wait_for(self.queue.get(),
+                                          timeout=POP_TIMEOUT)
+        return None
+
+    async def add_running(self, job_id: str) -> None:
+        self._running.add(job_id)
+
+    async def remove_running(self, job_id: str) -> None:
+        self._running.discard(job_id)
+
+    async def get_running(self) -> List[str]:
+        return list(self._running)
+
+
+def create_job_queue() -> JobQueue:
+    if app_settings.archive_job_queue == 'redis':
+        return RedisJobQueue(app_settings.redis_url)
+    return LocalJobQueue()
+
+
+archive_jobs = create_job_queue()
+
+
+async def submit_archive_job(db: AsyncSession,
+                             cache: RedisCacheBackend,
+                             user_obj: User,
+                             path: str,
+                             compression_type: str) -> dict:
+    path = await resolve_archive_path(db=db, cache=cache, path=path)
+    members = await resolve_archive_members(db=db,
+                                            user_id=user_obj.id,
+                                            path=path)
+    fingerprint = get_fingerprint(members)
+    request_hash = hashlib.md5(
+        f'{path}\0{compression_type}\0{fingerprint}'.encode()).hexdigest()
+    job = {
+        'id': str(uuid.uuid4()),
+        'user_id': str(user_obj.id),
+        'dedup_key': f'archive_job_for_{user_obj.id}_{request_hash}',
+        'path': path,
+        'compression_type': compression_type,
+        'status': 'queued',
+        'progress': 0,
+        'total_size': sum(member.size for member in members),
+        'created_at': datetime.utcnow(),
+    }
+    job = await archive_jobs.add_job(job)
+    logger.info('Archive job %s of %s is %s',
+                job['id'], path, job['status'])
+    return job
+
+
+async def get_archive_job(user_obj: User, job_id: uuid.UUID) -> dict:
+    job = await archive_jobs.get_job(str(job_id))
+    if job is None or job['user_id'] != str(user_obj.id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail='Archive job not found')
+    return job
+
+
+class ArchiveWorker:
+    """
+    Consumers of the archive job queue, archives are built by the
+    compression pool and saved to storage.
+
+    Progress is estimated as archive size to size of the files. A running
+    job saves a heartbeat, a job without one for HEARTBEAT_TIMEOUT was
+    left by a stopped worker and is queued again.
+    """
+
+    def __init__(self, queue: JobQueue):
+        self._queue = queue
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._consume())
+                       for _ in range(app_settings.archive_job_workers)]
+        self._tasks.append(asyncio.create_task(self._remove_expired()))
+        self._tasks.append(asyncio.create_task(self._requeue_stale()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._tasks = []
+        await self._queue.close()
+
+    async def _receive_job(self) -> Optional[dict]:
+        try:
+            job_id = await self._queue.pop()
+            if job_id is None:
+                return None
+            return await self._queue.get_job(job_id)
+        except (aioredis.RedisError, OSError) as error:
+            logger.warning('Archive jobs are not received: %s', error)
+            await asyncio.sleep(POP_TIMEOUT)
+            return None
+
+    async def _consume(self) -> None:
+        while True:
+            job = await self._receive_job()
+            if job is None or job['status'] != 'queued':
+                continue
+            try:
+                await self.run_job(job)
+            except Exception as error:
+                logger.exception('Archive job %s failed', job['id'])
+                with contextlib.suppress(Exception):
+                    await self._queue.fail_job(job, str(error))
+                    await self._queue.remove_running(job['id'])
+
+    async def _save_progress(self, job: dict) -> None:
+        job['heartbeat_at'] = time.time()
+        await self._queue.save_job(job)
+
+    async def _submit(self, job: dict, build_path: str,
+                      members: list) -> asyncio.Future:
+        while True:
+            try:
+                return await compression_pool.submit(compress_to_file,
+                                                     build_path,
+                                                     members,
+                                                     job['compression_type'])
+            except HTTPException:
+                # pool is busy with downloads, they go first
+                await asyncio.sleep(app_settings.compression_retry_after)
+                await self._save_progress(job)
+
+    async def run_job(self, job: dict) -> None:
+        job['status'] = 'running'
+        await self._save_progress(job)
+        # a job cancelled by shutdown stays in the running set
+        await self._queue.add_running(job['id'])
+        await self._build(job)
+        job.update(status='done', progress=1)
+        await self._queue.save_job(job)
+        await self._queue.remove_running(job['id'])
+        logger.info('Archive job %s is done', job['id'])
+
+    async def _build(self, job: dict) -> None:
+        async with async_session() as db:
+            members = await resolve_archive_members(
+                db=db, user_id=uuid.UUID(job['user_id']), path=job['path'])
+        job['total_size'] = sum(member.size for member in members)
+        build_path = await run_in_threadpool(create_build_file)
+        try:
+            task = await self._submit(job, build_path, members)
+            while not task.done():
+                await asyncio.wait([task], timeout=PROGRESS_INTERVAL)
+                job['size'] = os.path.getsize(build_path)
+                job['progress'] = min(
+                    job['size'] / max(job['total_size'], 1), 0.99)
+                await self._save_progress(job)
+            task.result()
+            await storage.put_file(get_archive_key(job), build_path)
+        finally:
+            remove_build_file(build_path)
+
+    async def requeue_stale_jobs(self) -> None:
+        """
+        Queue again running jobs without a recent heartbeat.
+        """
+        stale_at = time.time() - HEARTBEAT_TIMEOUT
+        for job_id in await self._queue.get_running():
+            job = await self._queue.get_job(job_id)
+            if job is not None and job['status'] == 'running':
+                if job.get('heartbeat_at', 0) >= stale_at:
+                    continue
+                logger.warning('Archive job %s is stale, queue it again',
+                               job_id)
+                job['status'] = 'queued'
+                await self._queue.save_job(job)
+                await self._queue.push(job_id)
+            await self._queue.remove_running(job_id)
+
+    async def _requeue_stale(self) -> None:
+        while True:
+            try:
+                await self.requeue_stale_jobs()
+            except Exception:
+                logger.exception('Stale archive jobs are not queued')
+            await asyncio.sleep(HEARTBEAT_TIMEOUT)
+
+    @staticmethod
+    async def remove_expired_archives() -> None:
+        expired_at = datetime.now(timezone.utc) - timedelta(
+            seconds=app_settings.archive_job_ttl)
+        async for key in storage.list(f'{ARCHIVES_FOLDER}/'):
+            stat = await storage.stat(key)
+            if stat is not None and stat.modified < expired_at:
+                await storage.delete(key)
+        # builds left by stopped workers
+        await run_in_threadpool(remove_stale_files,
+                                get_builds_path(),
+                                expired_at.timestamp())
+
+    async def _remove_expired(self) -> None:
+        while True:
+            await asyncio.sleep(app_settings.archive_job_cleanup_interval)
+            try:
+                await self.remove_expired_archives()
+            except Exception:
+                logger.exception('Expired archives are not removed')
+
+
+archive_worker = ArchiveWorker(archive_jobs)
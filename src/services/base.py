@@ -1,8 +1,10 @@
-from src.models.models import Directory, File, User
+from src.models.models import Blob, Directory, File, UploadSession, User
 from src.schemas.user_schemas import UserRegister
 
+from .blobs import RepositoryBlobDB
 from .directory import RepositoryDirectoryDB
 from .files import RepositoryFileDB
+from .uploads import RepositoryUploadSessionDB, UploadSweeper
 from .user import RepositoryUserDB
 
 
@@ -14,10 +16,24 @@ class RepositoryFile(RepositoryFileDB[File]):
     pass
 
 
-class RepositoryDirectory(RepositoryDirectoryDB[File]):
+class RepositoryDirectory(RepositoryDirectoryDB[Directory]):
+    pass
+
+
+class RepositoryUploadSession(RepositoryUploadSessionDB[UploadSession]):
+    pass
+
+
+class RepositoryBlob(RepositoryBlobDB[Blob]):
     pass
 
 
 user_crud = RepositoryUser(User)
-file_crud = RepositoryFile(File)
+blob_crud = RepositoryBlob(Blob)
 directory_crud = RepositoryDirectory(Directory)
+file_crud = RepositoryFile(File,
+                           blob_crud=blob_crud,
+                           directory_crud=directory_crud,
+                           user_crud=user_crud)
+upload_crud = RepositoryUploadSession(UploadSession, file_crud=file_crud)
+upload_sweeper = UploadSweeper(upload_crud)
@@ -0,0 +1,134 @@
+import contextlib
+import os
+import uuid
+from typing import Generic, Optional, Type, TypeVar
+
+from fastapi import HTTPException
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from starlette import status
+
+from src.core.config import app_settings
+from src.db.db import Base
+
+BLOBS_FOLDER = '.blobs'
+
+
+class Repository:
+    def acquire(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def release(self, *args, **kwargs):
+        raise NotImplementedError
+
+
+ModelType = TypeVar("ModelType", bound=Base)
+
+
+def get_blob_path(blob_hash: str) -> str:
+    return os.path.join(app_settings.files_folder_path,
+                        BLOBS_FOLDER,
+                        blob_hash[:2],
+                        blob_hash[2:4],
+                        blob_hash)
+
+
+def restore_blob(blob_path: str, source_path: Optional[str]) -> None:
+    """
+    Link a blob back from a file with the same content.
+
+    A blob file is removed after the transaction releasing its last
+    reference, a concurrent upload may add a reference in between.
+    """
+    if source_path is None or not os.path.exists(source_path):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail='Content is not stored, upload file with body.')
+    with contextlib.suppress(FileExistsError):
+        os.link(source_path, blob_path)
+
+
+def link_blob(blob_hash: str,
+              temp_path: Optional[str],
+              full_file_path: str,
+              source_path: Optional[str] = None) -> None:
+    """
+    Put content of a blob to full_file_path as a hard link.
+
+    temp_path holds the same content, it becomes the blob if there is no
+    blob on disk yet and is removed otherwise. Without temp_path a missing
+    blob is restored from source_path.
+    """
+    blob_path = get_blob_path(blob_hash)
+    link_path = f'{blob_path}.{uuid.uuid4().hex}.link'
+    try:
+        os.link(blob_path, link_path)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        if temp_path is None:
+            restore_blob(blob_path, source_path)
+        else:
+            os.replace(temp_path, blob_path)
+        os.link(blob_path, link_path)
+    else:
+        if temp_path is not None:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+    os.replace(link_path, full_file_path)
+
+
+def remove_blob(blob_path: str) -> None:
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(blob_path)
+
+
+class RepositoryBlobDB(Repository, Generic[ModelType]):
+    """
+    Content addressed storage, every File with the same content is a hard
+    link to one blob, ref_count holds the number of such files.
+    """
+
+    def __init__(self, model: Type[ModelType]):
+        self._model = model
+
+    async def acquire(self,
+                      db: AsyncSession,
+                      blob_hash: str,
+                      size: int) -> None:
+        statement = insert(self._model).values(
+            hash=blob_hash,
+            size=size,
+            ref_count=1
+        ).on_conflict_do_update(
+            index_elements=[self._model.hash],
+            set_={'ref_count': self._model.ref_count + 1}
+        )
+        await db.execute(statement=statement)
+
+    async def release(self,
+                      db: AsyncSession,
+                      blob_hash: str) -> Optional[str]:
+        """
+        Drop one reference, return blob path to remove after commit if it
+        was the last one.
+        """
+        statement = update(self._model).where(
+            self._model.hash == blob_hash
+        ).values(
+            ref_count=self._model.ref_count - 1
+        ).execution_options(synchronize_session=False)
+        await db.execute(statement=statement)
+        statement = select(self._model.ref_count).where(
+            self._model.hash == blob_hash)
+        result = await db.execute(statement=statement)
+        ref_count = result.scalar_one_or_none()
+        if ref_count is None or ref_count > 0:
+            return None
+        statement = delete(self._model).where(
+            self._model.hash == blob_hash,
+            self._model.ref_count <= 0
+        ).execution_options(synchronize_session=False)
+        await db.execute(statement=statement)
+        return get_blob_path(blob_hash)
@@ -1,45 +1,396 @@
-import json
+import asyncio
+import contextlib
+import functools
+import logging
+import time
 import uuid
-from datetime import datetime
-from typing import Callable, Type
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Iterator, Optional, Type
 
+import aioredis
+import orjson
+from aioredis import Redis
+from aioredis.commands import Pipeline
+from fastapi import HTTPException
 from fastapi_cache import caches
 from fastapi_cache.backends.redis import CACHE_KEY, RedisCacheBackend
 from pydantic import BaseModel
+from starlette import status
+
+from src.core.config import app_settings
+
+logger = logging.getLogger(__name__)
+
+LOCK_POLL_INTERVAL = 0.05
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+SUBSCRIBE_RETRY_INTERVAL = 1
+
+_flights: dict[str, asyncio.Future] = {}
+
+
+class LRUCache:
+    """
+    Bounded in-process cache, every entry lives until its own TTL is over
+    or it is pushed out by newer entries.
+    """
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._data = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expire_at, value = item
+        if expire_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        if ttl <= 0 or self._max_size <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def items(self) -> Iterator[tuple]:
+        for key, (_, value) in list(self._data.items()):
+            yield key, value
+
+    def clear(self) -> None:
+        self._data.clear()
 
 
 def redis_cache():
     return caches.get(CACHE_KEY)
 
 
-def serialized_data(value):
-    if isinstance(value, datetime):
-        return value.isoformat()
-    elif isinstance(value, uuid.UUID):
-        return str(value)
-    return value
+class LocalCache:
+    """
+    First level cache of a worker in front of Redis.
+
+    Every change of a key is published to the other workers, which drop
+    their copies. The cache is used only while the subscription is up,
+    so a worker never misses a change; stored values must not be
+    mutated by callers.
+    """
+
+    def __init__(self):
+        self._data = LRUCache(max_size=app_settings.local_cache_max_size)
+        self._worker_id = uuid.uuid4().hex
+        self._task: Optional[asyncio.Task] = None
+        self._active = False
+
+    def get(self, key: str) -> Optional[Any]:
+        if not self._active:
+            return None
+        return self._data.get(key)
+
+    def set(self, key: str, value: Any, expire: int) -> None:
+        if not self._active:
+            return
+        ttl = app_settings.local_cache_ttl
+        self._data.set(key, value, ttl=min(expire, ttl) if expire else ttl)
+
+    def _get_message(self, key: str) -> Optional[str]:
+        self._data.delete(key)
+        if not app_settings.local_cache_enabled:
+            return None
+        return f'{self._worker_id}:{key}'
+
+    async def publish(self, cache: RedisCacheBackend, key: str) -> None:
+        message = self._get_message(key)
+        if message is None:
+            return
+        client = await cache._client
+        await client.publish(app_settings.cache_invalidation_channel,
+                             message)
+
+    def publish_in(self, pipeline: Pipeline, key: str) -> None:
+        message = self._get_message(key)
+        if message is not None:
+            pipeline.publish(app_settings.cache_invalidation_channel,
+                             message)
+
+    def start(self, redis_url: str) -> None:
+        if app_settings.local_cache_enabled and self._task is None:
+            self._task = asyncio.create_task(self._listen(redis_url))
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    async def _listen(self, redis_url: str) -> None:
+        while True:
+            connection = None
+            try:
+                connection = await aioredis.create_redis(redis_url)
+                channel, = await connection.subscribe(
+                    app_settings.cache_invalidation_channel)
+                self._data.clear()
+                self._active = True
+                async for message in channel.iter(encoding='utf-8'):
+                    worker_id, _, key = message.partition(':')
+                    if worker_id != self._worker_id:
+                        self._data.delete(key)
+            except (aioredis.RedisError, OSError) as error:
+                logger.warning('Cache invalidation is not received: %s',
+                               error)
+            finally:
+                self._active = False
+                if connection is not None:
+                    connection.close()
+                    await connection.wait_closed()
+            await asyncio.sleep(SUBSCRIBE_RETRY_INTERVAL)
+
+
+local_cache = LocalCache()
 
 
 async def set_cache(
         cache: RedisCacheBackend,
-        data: dict,
+        data: Any,
         redis_key: str,
-        expire: int = 30
+        expire: int = 30,
+        only_new: bool = False
 ):
-    await cache.set(
+    """
+    only_new keeps a value already set, data read from database must not
+    overwrite a newer value written through by a concurrent change.
+    """
+    kwargs = {'exist': Redis.SET_IF_NOT_EXIST} if only_new else {}
+    is_set = await cache.set(
         key=redis_key,
-        value=json.dumps(data, default=serialized_data),
-        expire=expire
+        value=orjson.dumps(data),
+        expire=expire,
+        **kwargs
     )
+    if is_set:
+        await local_cache.publish(cache, redis_key)
+        local_cache.set(redis_key, data, expire)
 
 
-async def get_cache(cache: RedisCacheBackend, redis_key: str) -> dict:
+async def get_cache(cache: RedisCacheBackend, redis_key: str) -> Any:
+    data = local_cache.get(redis_key)
+    if data is not None:
+        return data
     data = await cache.get(redis_key)
     if data:
-        data = json.loads(data)
+        data = orjson.loads(data)
+        local_cache.set(redis_key, data, 0)
     return data
 
 
+async def get_many_cache(cache: RedisCacheBackend,
+                         redis_keys: list[str]) -> dict[str, Any]:
+    """
+    Return values of found keys, keys missing in the local cache are read
+    with one MGET.
+    """
+    found = {}
+    missed = []
+    for key in redis_keys:
+        data = local_cache.get(key)
+        if data is None:
+            missed.append(key)
+        else:
+            found[key] = data
+    if missed:
+        client = await cache._client
+        values = await client.mget(*missed)
+        for key, value in zip(missed, values):
+            if value:
+                found[key] = orjson.loads(value)
+                local_cache.set(key, found[key], 0)
+    return found
+
+
+async def set_many_cache(cache: RedisCacheBackend,
+                         items: list[tuple[str, Any, int, bool]]) -> None:
+    """
+    Set (key, data, expire, only_new) items in one pipeline.
+    """
+    client = await cache._client
+    pipeline = client.pipeline()
+    for key, data, expire, only_new in items:
+        pipeline.set(key,
+                     orjson.dumps(data),
+                     expire=expire,
+                     exist=Redis.SET_IF_NOT_EXIST if only_new else None)
+        local_cache.publish_in(pipeline, key)
+    await pipeline.execute()
+
+
+def get_file_key(user_id: uuid.UUID, path: str) -> str:
+    """
+    Key of file info looked up by path or by id, only by its owner.
+    """
+    if '/' in path and not path.startswith('/'):
+        path = '/' + path
+    return f'file_by_path_{user_id}_{path}'
+
+
+async def set_file_cache(cache: RedisCacheBackend,
+                         user_id: uuid.UUID,
+                         data: dict) -> None:
+    entry = make_entry(data, app_settings.file_cache_ttl)
+    for key in (get_file_key(user_id, data['path']),
+                get_file_key(user_id, str(data['id']))):
+        await set_cache(cache=cache,
+                        data=entry,
+                        redis_key=key,
+                        expire=(app_settings.file_cache_ttl
+                                + app_settings.cache_stale_ttl))
+
+
+async def get_files_list_key(cache: RedisCacheBackend,
+                             user_id: uuid.UUID,
+                             params_hash: str) -> str:
+    """
+    Listings of a user are cached under a version changed on every write,
+    so all pages of the user go stale at once.
+    """
+    version = await get_cache(cache, f'files_list_version_{user_id}')
+    return f'files_for_user_id_{user_id}_{version or 0}_{params_hash}'
+
+
+async def invalidate_files_list(cache: RedisCacheBackend,
+                                user_id: uuid.UUID) -> None:
+    await set_cache(cache=cache,
+                    data=uuid.uuid4().hex,
+                    redis_key=f'files_list_version_{user_id}',
+                    expire=0)
+
+
+def make_entry(data: Optional[dict],
+               fresh_ttl: float,
+               error: Optional[HTTPException] = None) -> dict:
+    """
+    Cached value with the time it may be served without revalidation.
+    """
+    entry = {'data': data, 'fresh_until': time.time() + fresh_ttl}
+    if error is not None:
+        entry['status_code'] = error.status_code
+        entry['detail'] = error.detail
+    return entry
+
+
+def get_entry(value: Any) -> Optional[dict]:
+    """
+    Return a cached value made by make_entry, values of other format
+    written by older code are a miss.
+    """
+    if isinstance(value, dict) and 'fresh_until' in value:
+        return value
+    return None
+
+
+def _unpack_entry(entry: dict) -> Optional[dict]:
+    if entry.get('status_code') is not None:
+        raise HTTPException(status_code=entry['status_code'],
+                            detail=entry['detail'])
+    return entry['data']
+
+
+async def _wait_for_entry(cache: RedisCacheBackend,
+                          redis_key: str) -> Optional[dict]:
+    """
+    Wait while another worker holding the lock loads the key.
+    """
+    deadline = time.monotonic() + app_settings.cache_lock_timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+        entry = get_entry(await get_cache(cache, redis_key))
+        if entry and entry['fresh_until'] > time.time():
+            return entry
+    return None
+
+
+async def _load_entry(load: Callable[[], Awaitable],
+                      data_schema: Type[BaseModel],
+                      cache_expire: int) -> dict:
+    try:
+        data = await load()
+    except HTTPException as error:
+        if error.status_code != status.HTTP_404_NOT_FOUND:
+            raise
+        return make_entry(None, app_settings.cache_negative_ttl, error)
+    if not data:
+        return make_entry(None, app_settings.cache_negative_ttl)
+    return make_entry(data_schema.from_orm(data).dict(), cache_expire)
+
+
+async def _release_lock(cache: RedisCacheBackend,
+                        lock_key: str,
+                        token: str) -> None:
+    """
+    Delete the lock only if it is still held with token, it may have
+    expired and be taken by another worker.
+    """
+    client = await cache._client
+    await client.eval(RELEASE_LOCK_SCRIPT, keys=[lock_key], args=[token])
+
+
+async def _refresh_entry(redis_key: str,
+                         cache: RedisCacheBackend,
+                         stale_entry: Optional[dict],
+                         load: Callable[[], Awaitable],
+                         data_schema: Type[BaseModel],
+                         cache_expire: int,
+                         only_new: bool) -> dict:
+    lock_key = f'lock_{redis_key}'
+    lock_token = None
+    if app_settings.cache_lock_enabled:
+        token = uuid.uuid4().hex
+        locked = await cache.set(
+            key=lock_key,
+            value=token,
+            pexpire=int(app_settings.cache_lock_timeout * 1000),
+            exist=Redis.SET_IF_NOT_EXIST)
+        if locked:
+            lock_token = token
+        else:
+            if stale_entry is not None:
+                return stale_entry
+            entry = await _wait_for_entry(cache, redis_key)
+            if entry is not None:
+                return entry
+    try:
+        entry = await _load_entry(load, data_schema, cache_expire)
+        if entry['data'] is None:
+            expire = app_settings.cache_negative_ttl
+        else:
+            expire = cache_expire + app_settings.cache_stale_ttl
+        await set_cache(cache=cache,
+                        data=entry,
+                        redis_key=redis_key,
+                        expire=expire,
+                        only_new=only_new)
+    finally:
+        if lock_token is not None:
+            await _release_lock(cache, lock_key, lock_token)
+    return entry
+
+
 async def get_cache_or_data(redis_key: str,
                             cache: RedisCacheBackend,
                             db_func_obj: Callable,
@@ -47,15 +398,50 @@ async def get_cache_or_data(redis_key: str,
                             db_func_args: tuple = (),
                             db_func_kwargs: dict = {},
                             cache_expire: int = 30):
-    data = await get_cache(cache, redis_key)
-    if not data:
-        data = await db_func_obj(*db_func_args, **db_func_kwargs)
-        if data:
-            data = data_schema.from_orm(data).dict()
-            await set_cache(cache=cache,
-                            data=data,
-                            redis_key=redis_key,
-                            expire=cache_expire)
-        else:
-            return None
-    return data
+    """
+    Return cached data or load it from database.
+
+    A key is loaded by one request of a worker at a time, the others wait
+    for it or get the stale value while it is revalidated. With
+    cache_lock_enabled the same holds for all workers. Not found results
+    are cached for cache_negative_ttl.
+    """
+    value = await get_cache(cache, redis_key)
+    entry = get_entry(value)
+    if entry and entry['fresh_until'] > time.time():
+        return _unpack_entry(entry)
+    flight = _flights.get(redis_key)
+    while flight is not None:
+        if entry:
+            return _unpack_entry(entry)
+        await asyncio.wait([flight])
+        if not flight.cancelled():
+            return _unpack_entry(flight.result())
+        # the loading request was cancelled, the load is retried
+        flight = _flights.get(redis_key)
+    flight = asyncio.get_running_loop().create_future()
+    _flights[redis_key] = flight
+    try:
+        entry = await _refresh_entry(
+            redis_key=redis_key,
+            cache=cache,
+            stale_entry=entry,
+            load=functools.partial(db_func_obj,
+                                   *db_func_args,
+                                   **db_func_kwargs),
+            data_schema=data_schema,
+            cache_expire=cache_expire,
+            only_new=not value)
+    except Exception as error:
+        flight.set_exception(error)
+        # waiters get the error, it must not be reported as lost
+        flight.exception()
+        raise
+    except BaseException:
+        flight.cancel()
+        raise
+    else:
+        flight.set_result(entry)
+    finally:
+        _flights.pop(redis_key, None)
+    return _unpack_entry(entry)
@@ -1,11 +1,17 @@
+import os
 import uuid
-from typing import Generic, Optional, Type, TypeVar
+from datetime import datetime
+from typing import Generic, List, Optional, Type, TypeVar
 
+from sqlalchemy import or_, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
 from src.db.db import Base
 
+DIRECTORY_NAMESPACE = uuid.UUID('6f1c9a52-3b8e-4d07-9a4e-2c5d8b7e1f30')
+
 
 class Repository:
     def get_dir_info_by_path(self, *args, **kwargs):
@@ -14,23 +20,55 @@ class Repository:
     def get_dir_info_by_id(self, *args, **kwargs):
         raise NotImplementedError
 
-    def create_dir_info(self, *args, **kwargs):
+    def get_dir_with_children(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def create_dirs_info(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def update_dirs_stats(self, *args, **kwargs):
         raise NotImplementedError
 
 
 ModelType = TypeVar("ModelType", bound=Base)
 
 
+def get_dir_id(user_id: uuid.UUID, dir_path: str) -> uuid.UUID:
+    """
+    Id of a folder is derived from its owner and path, so a parent is
+    referenced without reading it and concurrent uploads add the same
+    rows.
+    """
+    return uuid.uuid5(DIRECTORY_NAMESPACE, f'{user_id}:{dir_path}')
+
+
+def get_parent_id(user_id: uuid.UUID,
+                  dir_path: str) -> Optional[uuid.UUID]:
+    parent_path = os.path.dirname(dir_path)
+    if parent_path == '/':
+        return None
+    return get_dir_id(user_id, parent_path)
+
+
 class RepositoryDirectoryDB(Repository, Generic[ModelType]):
+    """
+    Folders of a user with the parent and counters of all files below
+    them, counters are changed in the transaction the file is saved.
+    Users have own folders with the same path.
+    """
+
     def __init__(self, model: Type[ModelType]):
         self._model = model
 
     async def get_dir_info_by_path(self,
                                    db: AsyncSession,
-                                   dir_path: str) -> Optional[ModelType]:
+                                   dir_path: str,
+                                   user_id: uuid.UUID) -> Optional[ModelType]:
         if not dir_path.startswith('/'):
             dir_path = '/' + dir_path
-        statement = select(self._model).where(self._model.path == dir_path)
+        statement = select(self._model).where(
+            self._model.user_id == user_id,
+            self._model.path == dir_path)
         result = await db.execute(statement=statement)
         return result.scalar_one_or_none()
 
@@ -40,3 +78,75 @@ class RepositoryDirectoryDB(Repository, Generic[ModelType]):
         statement = select(self._model).where(self._model.id == dir_id)
         result = await db.execute(statement=statement)
         return result.scalar_one_or_none()
+
+    async def get_dir_with_children(
+            self,
+            db: AsyncSession,
+            dir_path: str,
+            user_id: uuid.UUID) -> tuple[Optional[ModelType], list]:
+        """
+        Return a folder and its subfolders in one query, top folders of
+        the user for the root.
+        """
+        dir_path = '/' + dir_path.strip('/')
+        statement = select(self._model).where(self._model.user_id == user_id)
+        if dir_path == '/':
+            statement = statement.where(self._model.parent_id.is_(None))
+        else:
+            dir_id = get_dir_id(user_id, dir_path)
+            statement = statement.where(
+                or_(self._model.id == dir_id,
+                    self._model.parent_id == dir_id))
+        statement = statement.order_by(self._model.path)
+        results = await db.execute(statement=statement)
+        folder = None
+        children = []
+        for dir_info in results.scalars().all():
+            if dir_info.path == dir_path:
+                folder = dir_info
+            else:
+                children.append(dir_info)
+        return folder, children
+
+    async def create_dirs_info(self,
+                               db: AsyncSession,
+                               dir_paths: List[str],
+                               user_id: uuid.UUID) -> None:
+        """
+        Add folders which are not known yet in one statement, the caller
+        commits.
+        """
+        if not dir_paths:
+            return
+        statement = insert(self._model).values(
+            [{'id': get_dir_id(user_id, dir_path),
+              'parent_id': get_parent_id(user_id, dir_path),
+              'user_id': user_id,
+              'path': dir_path} for dir_path in dir_paths]
+        ).on_conflict_do_nothing(
+            index_elements=[self._model.user_id, self._model.path])
+        await db.execute(statement=statement)
+
+    async def update_dirs_stats(self,
+                                db: AsyncSession,
+                                dir_paths: List[str],
+                                user_id: uuid.UUID,
+                                file_count: int,
+                                size: int,
+                                modified: datetime) -> None:
+        """
+        Add file_count and size to counters of folders of the user, the
+        caller commits.
+        """
+        if not dir_paths:
+            return
+        statement = update(self._model).where(
+            self._model.user_id == user_id,
+            self._model.id.in_([get_dir_id(user_id, path)
+                                for path in dir_paths])
+        ).values(
+            file_count=self._model.file_count + file_count,
+            total_size=self._model.total_size + size,
+            last_modified=modified
+        ).execution_options(synchronize_session=False)
+        await db.execute(statement=statement)
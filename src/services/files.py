@@ -1,15 +1,171 @@
+import base64
+import binascii
+import contextlib
+import hashlib
+import json
+import logging
 import os
+import uuid
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Generic, Optional, Type, TypeVar
+from typing import (AsyncIterator, BinaryIO, Generic, Optional, Sequence, Type,
+                    TypeVar, Union)
 
-from aioshutil import copyfileobj
+import aioredis
+from aiofile import async_open
 from fastapi import File as FileObj
+from fastapi import HTTPException
+from sqlalchemy import or_, tuple_
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from starlette import status
+from starlette.concurrency import run_in_threadpool
 
 from src.core.config import app_settings
 from src.db.db import Base
 from src.models.models import File, User
+from src.schemas import file_schemas
+from src.services.archive_cache import archive_cache, get_parent_paths
+from src.services.blobs import (BLOBS_FOLDER, get_blob_path, link_blob,
+                                remove_blob)
+from src.services.cache import (invalidate_files_list, redis_cache,
+                                set_file_cache)
+from src.services.storage import (ARCHIVES_FOLDER, OBJECTS_FOLDER,
+                                  get_new_storage_path, get_storage_key,
+                                  storage)
+
+logger = logging.getLogger(__name__)
+
+UPLOADS_FOLDER = '.uploads'
+RESERVED_FOLDERS = (UPLOADS_FOLDER, BLOBS_FOLDER, OBJECTS_FOLDER,
+                    ARCHIVES_FOLDER)
+LIST_ORDERS = {
+    'created_at': ('created_at', 'id'),
+    'path': ('path',),
+}
+
+
+@dataclass
+class StagedFile:
+    """
+    File already written to the storage volume, moved into place on save.
+    """
+    filename: str
+    temp_path: Optional[str]
+    size: int
+    sha256: Optional[str] = None
+
+    def discard(self) -> None:
+        if self.temp_path is None:
+            return
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.temp_path)
+
+
+def get_dir_paths(file_path: str) -> list:
+    """
+    Folders a file is placed in, without the root.
+    """
+    return get_parent_paths(os.path.dirname(file_path))[1:]
+
+
+def is_reserved_path(file_path: str) -> bool:
+    return file_path.split('/')[1] in RESERVED_FOLDERS
+
+
+def check_owner(file_info: File, user_obj: User) -> None:
+    """
+    Paths are shared by all users, a file is replaced only by its owner.
+    """
+    if file_info.user_id != user_obj.id:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail='Path is used by another user.')
+
+
+def _get_file_size(file_obj: BinaryIO) -> int:
+    file_obj.seek(0, os.SEEK_END)
+    size = file_obj.tell()
+    file_obj.seek(0)
+    return size
+
+
+async def get_upload_size(file_obj: FileObj) -> int:
+    """
+    Size of a received form file, it is spooled to disk if big.
+    """
+    return await run_in_threadpool(_get_file_size, file_obj.file)
+
+
+async def iter_upload_file(file_obj: FileObj) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await file_obj.read(app_settings.upload_chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def stage_file(chunks: AsyncIterator[bytes],
+                     filename: str) -> StagedFile:
+    """
+    Write chunks into a temporary file on the storage volume, size and
+    hash are counted on the fly.
+    """
+    uploads_path = os.path.join(app_settings.files_folder_path,
+                                UPLOADS_FOLDER)
+    os.makedirs(uploads_path, exist_ok=True)
+    staged_file = StagedFile(
+        filename=filename,
+        temp_path=os.path.join(uploads_path, f'{uuid.uuid4()}.tmp'),
+        size=0)
+    sha256 = hashlib.sha256()
+    try:
+        async with async_open(staged_file.temp_path, 'wb') as temp_file:
+            async for chunk in chunks:
+                await temp_file.write(chunk)
+                sha256.update(chunk)
+                staged_file.size += len(chunk)
+    except BaseException:
+        staged_file.discard()
+        raise
+    staged_file.sha256 = sha256.hexdigest()
+    return staged_file
+
+
+def escape_like(value: str) -> str:
+    for char in ('\\', '%', '_'):
+        value = value.replace(char, '\\' + char)
+    return value
+
+
+def glob_to_like(pattern: str) -> str:
+    """
+    Translate * and ? of a glob to a LIKE pattern escaped by backslash.
+    """
+    return escape_like(pattern).replace('*', '%').replace('?', '_')
+
+
+def encode_cursor(order_by: str, values: Sequence) -> str:
+    data = json.dumps([order_by, [str(value) for value in values]])
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(order_by: str, cursor: str) -> tuple:
+    """
+    Return sort key of the last row of the previous page.
+    """
+    try:
+        cursor_order, values = json.loads(base64.urlsafe_b64decode(cursor))
+        names = LIST_ORDERS[order_by]
+        if cursor_order != order_by or len(values) != len(names):
+            raise ValueError(cursor_order)
+        converters = {'created_at': datetime.fromisoformat,
+                      'id': uuid.UUID,
+                      'path': str}
+        return tuple(converters[name](value)
+                     for name, value in zip(names, values))
+    except (binascii.Error, TypeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail='Invalid cursor.')
 
 
 class Repository:
@@ -19,7 +175,13 @@ class Repository:
     def get_file_info_by_id(self, *args, **kwargs):
         raise NotImplementedError
 
-    def get_list_by_user_object(self, *args, **kwargs):
+    def get_files_info_by_paths(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def get_list_by_folder(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def get_page_by_user_object(self, *args, **kwargs):
         raise NotImplementedError
 
     def create_or_put_file(self, *args, **kwargs):
@@ -30,66 +192,181 @@ ModelType = TypeVar("ModelType", bound=Base)
 
 
 class RepositoryFileDB(Repository, Generic[ModelType]):
-    def __init__(self, model: Type[ModelType]):
+    def __init__(self,
+                 model: Type[ModelType],
+                 blob_crud=None,
+                 directory_crud=None,
+                 user_crud=None):
         self._model = model
+        self._blob_crud = blob_crud
+        self._directory_crud = directory_crud
+        self._user_crud = user_crud
 
     async def _write_to_file(self,
-                             file_obj: FileObj,
-                             full_file_path: str, ):
-        with open(full_file_path, 'wb') as buffer:
-            await copyfileobj(file_obj.file, buffer)
+                             db: AsyncSession,
+                             file_obj: StagedFile,
+                             storage_key: str, ) -> StagedFile:
+        """
+        Move content into place, identical content is stored once when
+        deduplication is enabled and storage is local.
+        """
+        dedup_enabled = app_settings.dedup_enabled and storage.is_local
+        if not dedup_enabled or file_obj.sha256 is None:
+            await storage.put_file(storage_key, file_obj.temp_path)
+            file_obj.sha256 = None
+            return file_obj
+        await self._blob_crud.acquire(db=db,
+                                      blob_hash=file_obj.sha256,
+                                      size=file_obj.size)
+        source_path = None
+        if (file_obj.temp_path is None
+                and not os.path.exists(get_blob_path(file_obj.sha256))):
+            source_path = await self._get_content_path(
+                db=db, blob_hash=file_obj.sha256)
+        full_file_path = storage.get_local_path(storage_key)
+        os.makedirs(os.path.dirname(full_file_path), exist_ok=True)
+        link_blob(blob_hash=file_obj.sha256,
+                  temp_path=file_obj.temp_path,
+                  full_file_path=full_file_path,
+                  source_path=source_path)
+        return file_obj
+
+    async def _get_content_path(self,
+                                db: AsyncSession,
+                                blob_hash: str) -> Optional[str]:
+        """
+        Return local path of a stored file with the content.
+        """
+        statement = select(self._model.path, self._model.storage_path).where(
+            self._model.blob_hash == blob_hash).limit(1)
+        result = await db.execute(statement=statement)
+        row = result.one_or_none()
+        if row is None:
+            return None
+        return storage.get_local_path(get_storage_key(row.path,
+                                                      row.storage_path))
+
+    async def _discard_new_file(self,
+                                db: AsyncSession,
+                                stored_file: StagedFile,
+                                storage_key: str) -> None:
+        """
+        Roll back a new file which is stored already, its blob is
+        removed if no other file uses it.
+        """
+        released_blob_path = None
+        if stored_file.sha256 is not None:
+            released_blob_path = await self._blob_crud.release(
+                db=db, blob_hash=stored_file.sha256)
+        await db.rollback()
+        await storage.delete(storage_key)
+        if released_blob_path is not None:
+            remove_blob(released_blob_path)
 
     async def create_file(self,
                           db: AsyncSession,
                           file_path: str,
-                          full_file_path: str,
-                          create_dir_info,
-                          file_obj: FileObj,
+                          file_obj: StagedFile,
                           model: Type[File],
                           user_obj: Type[User]):
-        path = app_settings.files_folder_path
-        for dir_name in file_path.split('/')[1:-1]:
-            path = os.path.join(path, dir_name)
-            if os.path.exists(path):
-                continue
-            else:
-                os.mkdir(path)
-                await create_dir_info(db=db, path=path)
-        await self._write_to_file(file_obj=file_obj,
-                                  full_file_path=full_file_path)
-        size = os.path.getsize(full_file_path)
-        new_file = model(name=file_obj.filename,
+        """
+        Save a new file, usage of the user and counters of its folders
+        are updated in the same transaction.
+        """
+        file_id = uuid.uuid1()
+        storage_path = get_new_storage_path(file_id)
+        storage_key = get_storage_key(file_path, storage_path)
+        stored_file = await self._write_to_file(db=db,
+                                                file_obj=file_obj,
+                                                storage_key=storage_key)
+        new_file = model(id=file_id,
+                         name=file_obj.filename,
                          path=file_path,
-                         size=size,
+                         storage_path=storage_path,
+                         size=stored_file.size,
+                         blob_hash=stored_file.sha256,
                          is_downloadable=True,
-                         user=user_obj)
+                         created_at=datetime.utcnow(),
+                         user_id=user_obj.id)
         db.add(new_file)
+        dir_paths = get_dir_paths(file_path)
+        await self._directory_crud.create_dirs_info(db=db,
+                                                    dir_paths=dir_paths,
+                                                    user_id=user_obj.id)
+        await self._directory_crud.update_dirs_stats(
+            db=db,
+            dir_paths=dir_paths,
+            user_id=user_obj.id,
+            file_count=1,
+            size=new_file.size,
+            modified=new_file.created_at)
+        try:
+            # the user row is locked only until commit
+            await self._user_crud.add_usage(db=db,
+                                            user_id=user_obj.id,
+                                            size=stored_file.size,
+                                            file_count=1)
+        except HTTPException:
+            # concurrent uploads took the rest of the quota
+            await self._discard_new_file(db=db,
+                                         stored_file=stored_file,
+                                         storage_key=storage_key)
+            raise
         await db.commit()
+        await self._user_crud.invalidate_user(user_obj.id)
         await db.refresh(new_file)
         return new_file
 
     async def put_file(self,
                        db: AsyncSession,
-                       file_obj: FileObj,
-                       full_file_path: str,
+                       file_obj: StagedFile,
+                       storage_key: str,
                        file_info: Type[File]):
-        await self._write_to_file(
+        """
+        Replace content of a file. The old content can't be restored
+        once it is replaced, so the size change is counted against the
+        quota before the write.
+        """
+        await self._user_crud.add_usage(db=db,
+                                        user_id=file_info.user_id,
+                                        size=file_obj.size - file_info.size,
+                                        file_count=0)
+        stored_file = await self._write_to_file(
+            db=db,
             file_obj=file_obj,
-            full_file_path=full_file_path
+            storage_key=storage_key
         )
-        size = os.path.getsize(full_file_path)
-        file_info.size = size
+        released_blob_path = None
+        if file_info.blob_hash is not None:
+            released_blob_path = await self._blob_crud.release(
+                db=db, blob_hash=file_info.blob_hash)
+        await self._directory_crud.update_dirs_stats(
+            db=db,
+            dir_paths=get_dir_paths(file_info.path),
+            user_id=file_info.user_id,
+            file_count=0,
+            size=stored_file.size - file_info.size,
+            modified=datetime.utcnow())
+        file_info.size = stored_file.size
+        file_info.blob_hash = stored_file.sha256
         file_info.created_at = datetime.utcnow()
         await db.commit()
+        await self._user_crud.invalidate_user(file_info.user_id)
         await db.refresh(file_info)
+        if released_blob_path is not None:
+            remove_blob(released_blob_path)
         return file_info
 
     async def get_file_info_by_path(self,
                                     db: AsyncSession,
-                                    file_path: str) -> Optional[ModelType]:
+                                    file_path: str,
+                                    for_update: bool = False
+                                    ) -> Optional[ModelType]:
         if not file_path.startswith('/'):
             file_path = '/' + file_path
         statement = select(self._model).where(self._model.path == file_path)
+        if for_update:
+            statement = statement.with_for_update()
         result = await db.execute(statement=statement)
         return result.scalar_one_or_none()
 
@@ -109,43 +386,232 @@ class RepositoryFileDB(Repository, Generic[ModelType]):
         result = await db.execute(statement=statement)
         return result.scalar_one_or_none()
 
-    async def get_list_by_user_object(self,
+    async def get_files_info_by_paths(self,
                                       db: AsyncSession,
-                                      user_obj: ModelType,
-                                      ) -> list[ModelType]:
+                                      user_id: uuid.UUID,
+                                      paths: Sequence[str]
+                                      ) -> dict[str, ModelType]:
+        """
+        Find files of the user by paths or ids in one query, result is
+        keyed by the requested path or id.
+        """
+        file_paths = {}
+        file_ids = {}
+        for path in paths:
+            if '/' in path:
+                file_path = path if path.startswith('/') else '/' + path
+                file_paths[file_path] = path
+                continue
+            with contextlib.suppress(ValueError):
+                file_ids[uuid.UUID(path)] = path
+        if not file_paths and not file_ids:
+            return {}
+        statement = select(self._model).where(
+            self._model.user_id == user_id,
+            or_(self._model.path.in_(file_paths),
+                self._model.id.in_(file_ids)))
+        results = await db.execute(statement=statement)
+        files = {}
+        for file_info in results.scalars().all():
+            if file_info.path in file_paths:
+                files[file_paths[file_info.path]] = file_info
+            if file_info.id in file_ids:
+                files[file_ids[file_info.id]] = file_info
+        return files
+
+    async def get_list_by_folder(self,
+                                 db: AsyncSession,
+                                 folder_path: str,
+                                 recursive: bool = False,
+                                 user_id: Optional[uuid.UUID] = None
+                                 ) -> list[ModelType]:
+        """
+        Files placed right in a folder, also in its subfolders if
+        recursive, only of the user if user_id is given.
+        """
+        prefix = escape_like(folder_path.rstrip('/') + '/')
         statement = select(self._model).where(
-            self._model.user_id == user_obj.id)
+            self._model.path.like(prefix + '%', escape='\\'))
+        if user_id is not None:
+            statement = statement.where(self._model.user_id == user_id)
+        if not recursive:
+            statement = statement.where(
+                self._model.path.notlike(prefix + '%/%', escape='\\'))
+        statement = statement.order_by(self._model.path)
         results = await db.execute(statement=statement)
         return results.scalars().all()
 
-    async def create_dir_info(self,
-                              db: AsyncSession,
-                              path: str) -> ModelType:
-        dir_info_obj = self._model(path=path)
-        db.add(dir_info_obj)
-        await db.commit()
-        await db.refresh(dir_info_obj)
-        return dir_info_obj
+    async def has_content(self,
+                          db: AsyncSession,
+                          user_obj: ModelType,
+                          blob_hash: str) -> Optional[int]:
+        """
+        Return size of the content if user already stores it.
+        """
+        statement = select(self._model.size).where(
+            self._model.user_id == user_obj.id,
+            self._model.blob_hash == blob_hash).limit(1)
+        result = await db.execute(statement=statement)
+        return result.scalar_one_or_none()
 
-    async def create_or_put_file(self,
-                                 db: AsyncSession,
-                                 user_obj: ModelType,
-                                 file_obj: FileObj,
-                                 file_path: str) -> Optional[ModelType]:
+    def _get_list_filters(self,
+                          path_prefix: Optional[str] = None,
+                          min_size: Optional[int] = None,
+                          max_size: Optional[int] = None,
+                          created_after: Optional[datetime] = None,
+                          created_before: Optional[datetime] = None,
+                          name: Optional[str] = None,
+                          path_contains: Optional[str] = None,
+                          glob: Optional[str] = None) -> list:
+        """
+        Prefix is served by a text_pattern_ops index on path, substrings
+        and globs by trigram indexes on name and path.
+        """
+        filters = []
+        if path_prefix:
+            filters.append(self._model.path.startswith(path_prefix,
+                                                       autoescape=True))
+        if name:
+            filters.append(self._model.name.ilike(
+                '%' + escape_like(name) + '%', escape='\\'))
+        if path_contains:
+            filters.append(self._model.path.ilike(
+                '%' + escape_like(path_contains) + '%', escape='\\'))
+        if glob:
+            column = self._model.path if '/' in glob else self._model.name
+            filters.append(column.like(glob_to_like(glob), escape='\\'))
+        if min_size is not None:
+            filters.append(self._model.size >= min_size)
+        if max_size is not None:
+            filters.append(self._model.size <= max_size)
+        if created_after is not None:
+            filters.append(self._model.created_at >= created_after)
+        if created_before is not None:
+            filters.append(self._model.created_at < created_before)
+        return filters
+
+    async def get_page_by_user_object(self,
+                                      db: AsyncSession,
+                                      user_obj: ModelType,
+                                      limit: int,
+                                      order_by: str = 'created_at',
+                                      cursor: Optional[str] = None,
+                                      fields: Optional[Sequence[str]] = None,
+                                      **filters) -> tuple[list, Optional[str]]:
+        """
+        Return a page of files and a cursor of the next page.
+
+        Pages are sorted by order_by and fetched by keyset, so every page
+        is an index range scan on (user_id, created_at, id) or
+        (user_id, path).
+        """
+        sort_names = LIST_ORDERS[order_by]
+        sort_columns = [getattr(self._model, name) for name in sort_names]
+        names = list(dict.fromkeys([*fields, *sort_names]))
+        statement = select(
+            *(getattr(self._model, name) for name in names)
+        ).where(
+            self._model.user_id == user_obj.id,
+            *self._get_list_filters(**filters)
+        ).order_by(*sort_columns).limit(limit + 1)
+        if cursor is not None:
+            statement = statement.where(
+                tuple_(*sort_columns) > decode_cursor(order_by, cursor))
+        results = await db.execute(statement=statement)
+        rows = results.mappings().all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(
+                order_by, [rows[-1][name] for name in sort_names])
+        page = [{name: row[name] for name in fields} for row in rows]
+        return page, next_cursor
+
+    @staticmethod
+    async def update_cache(file_info: ModelType) -> None:
+        """
+        Write new file info through to cache and evict listings of its
+        owner, call it after every change of a file.
+        """
+        cache = redis_cache()
+        if cache is None:
+            return
+        try:
+            await set_file_cache(cache,
+                                 file_info.user_id,
+                                 file_schemas.File.from_orm(file_info).dict())
+            await invalidate_files_list(cache, file_info.user_id)
+        except (aioredis.RedisError, OSError) as error:
+            logger.error('Cache of %s is not updated: %s',
+                         file_info.path, error)
+
+    async def check_quota(self,
+                          db: AsyncSession,
+                          user_obj: ModelType,
+                          file_path: str,
+                          size: int) -> None:
+        """
+        Reject a file of size which does not fit quotas of the user,
+        counting out the file it replaces.
+        """
         file_in_storage = await self.get_file_info_by_path(db=db,
                                                            file_path=file_path)
-        full_file_path = app_settings.files_folder_path + file_path
         if file_in_storage:
+            check_owner(file_in_storage, user_obj)
+            size -= file_in_storage.size
+        await self._user_crud.check_quota(
+            db=db,
+            user_id=user_obj.id,
+            size=size,
+            file_count=0 if file_in_storage else 1)
+
+    async def _save_file(self,
+                         db: AsyncSession,
+                         user_obj: ModelType,
+                         file_obj: StagedFile,
+                         file_path: str) -> ModelType:
+        file_in_storage = await self.get_file_info_by_path(db=db,
+                                                           file_path=file_path,
+                                                           for_update=True)
+        if file_in_storage:
+            check_owner(file_in_storage, user_obj)
             return await self.put_file(
                 db=db,
-                full_file_path=full_file_path,
+                storage_key=get_storage_key(file_in_storage.path,
+                                            file_in_storage.storage_path),
                 file_info=file_in_storage,
                 file_obj=file_obj)
-        return await self.create_file(
-            db=db,
-            file_path=file_path,
-            full_file_path=full_file_path,
-            create_dir_info=self.create_dir_info,
-            file_obj=file_obj,
-            model=self._model,
-            user_obj=user_obj)
+        return await self.create_file(db=db,
+                                      file_path=file_path,
+                                      file_obj=file_obj,
+                                      model=self._model,
+                                      user_obj=user_obj)
+
+    async def create_or_put_file(self,
+                                 db: AsyncSession,
+                                 user_obj: ModelType,
+                                 file_obj: Union[FileObj, StagedFile],
+                                 file_path: str) -> Optional[ModelType]:
+        if is_reserved_path(file_path):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail='Path is reserved.')
+        staged_file = file_obj
+        if not isinstance(file_obj, StagedFile):
+            staged_file = await stage_file(iter_upload_file(file_obj),
+                                           file_obj.filename)
+        try:
+            await self.check_quota(db=db,
+                                   user_obj=user_obj,
+                                   file_path=file_path,
+                                   size=staged_file.size)
+            file_info = await self._save_file(db=db,
+                                              user_obj=user_obj,
+                                              file_obj=staged_file,
+                                              file_path=file_path)
+        finally:
+            if staged_file is not file_obj:
+                staged_file.discard()
+        archive_cache.invalidate(file_path)
+        await self.update_cache(file_info)
+        return file_info
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+from fastapi import HTTPException
+from starlette import status
+
+from src.core.config import app_settings
+
+logger = logging.getLogger(__name__)
+
+
+class CompressionPool:
+    """
+    Process pool for archive compression with a cap on running jobs.
+
+    Workers are started by a fork server, forking the threaded event
+    loop process itself may deadlock in a child.
+    """
+
+    def __init__(self):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def start(self) -> None:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=app_settings.compression_workers,
+                mp_context=multiprocessing.get_context('forkserver'))
+            self._slots = asyncio.Semaphore(
+                app_settings.compression_max_concurrent)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._slots = None
+
+    async def _acquire(self) -> None:
+        try:
+            await asyncio.wait_for(
+                self._slots.acquire(),
+                timeout=app_settings.compression_queue_timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Compression queue is full.')
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='Too many archives in progress.',
+                headers={
+                    'Retry-After': str(app_settings.compression_retry_after)})
+
+    async def submit(self, func: Callable, *args) -> asyncio.Future:
+        """
+        Wait for a free slot and run func in a worker process.
+
+        The slot is released when the job is finished, even if nobody
+        awaits the returned future anymore.
+        """
+        self.start()
+        await self._acquire()
+        slots = self._slots
+        loop = asyncio.get_running_loop()
+        try:
+            job = loop.run_in_executor(self._executor, func, *args)
+        except Exception:
+            slots.release()
+            raise
+        job.add_done_callback(lambda _: slots.release())
+        return job
+
+
+compression_pool = CompressionPool()
@@ -0,0 +1,343 @@
+import os
+import uuid
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from functools import partial
+from typing import AsyncIterator, Callable, Mapping, Optional
+from urllib.parse import quote
+
+from aiofile import async_open
+from fastapi import HTTPException
+from starlette import status
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+from src.core.config import app_settings
+from src.services.storage import storage
+
+MAX_RANGES = 16
+
+
+def get_content_disposition(filename: str) -> str:
+    quoted_filename = quote(filename)
+    if quoted_filename != filename:
+        return f"attachment; filename*=utf-8''{quoted_filename}"
+    return f'attachment; filename="{filename}"'
+
+
+def get_accel_uri(full_path: str) -> Optional[str]:
+    """
+    Map a file of the storage or of the archive cache to internal nginx
+    location.
+    """
+    locations = (
+        (app_settings.files_folder_path,
+         app_settings.accel_redirect_files_location),
+        (app_settings.archive_cache_dir,
+         app_settings.accel_redirect_archives_location),
+    )
+    full_path = os.path.abspath(full_path)
+    for root_path, location in locations:
+        root_path = os.path.abspath(root_path)
+        if os.path.commonpath([root_path, full_path]) == root_path:
+            relative_path = os.path.relpath(full_path, root_path)
+            return location.rstrip('/') + '/' + quote(relative_path)
+    return None
+
+
+def _as_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def get_etag(size: int, modified: datetime) -> str:
+    """
+    Strong ETag built from file metadata stored in database.
+    """
+    timestamp = int(_as_utc(modified).timestamp() * 1_000_000)
+    return f'"{size:x}-{timestamp:x}"'
+
+
+def get_http_date(value: datetime) -> str:
+    return format_datetime(_as_utc(value), usegmt=True)
+
+
+def _parse_http_date(value: str) -> Optional[datetime]:
+    try:
+        return _as_utc(parsedate_to_datetime(value))
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _strip_weak(etag: str) -> str:
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def is_not_modified(request_headers: Mapping,
+                    etag: str,
+                    last_modified: datetime) -> bool:
+    if_none_match = request_headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [_strip_weak(tag.strip())
+                for tag in if_none_match.split(',')]
+        return '*' in tags or _strip_weak(etag) in tags
+    if_modified_since = request_headers.get('if-modified-since')
+    if if_modified_since is not None:
+        since = _parse_http_date(if_modified_since)
+        modified = _as_utc(last_modified).replace(microsecond=0)
+        return since is not None and modified <= since
+    return False
+
+
+def _parse_range_spec(range_spec: str, size: int) -> Optional[tuple]:
+    """
+    Raise ValueError for malformed spec, return None if out of file.
+    """
+    start, separator, end = range_spec.strip().partition('-')
+    if not separator:
+        raise ValueError(range_spec)
+    if not start:
+        suffix_length = int(end)
+        if suffix_length <= 0 or size == 0:
+            return None
+        return max(size - suffix_length, 0), size - 1
+    start = int(start)
+    if end and int(end) < start:
+        raise ValueError(range_spec)
+    if start >= size:
+        return None
+    return start, min(int(end), size - 1) if end else size - 1
+
+
+def parse_range_header(range_header: str, size: int) -> Optional[list]:
+    """
+    Return sorted (start, end) pairs of a Range header.
+
+    None means the header must be ignored, an empty list means that no
+    range can be satisfied.
+    """
+    unit, _, ranges_spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    try:
+        ranges = [_parse_range_spec(range_spec, size)
+                  for range_spec in ranges_spec.split(',')]
+    except ValueError:
+        return None
+    ranges = [byte_range for byte_range in ranges if byte_range]
+    if len(ranges) > MAX_RANGES:
+        return None
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def get_requested_ranges(request_headers: Mapping,
+                         size: int,
+                         etag: str,
+                         last_modified: datetime) -> Optional[list]:
+    range_header = request_headers.get('range')
+    if range_header is None:
+        return None
+    if_range = request_headers.get('if-range')
+    if if_range is not None:
+        if if_range.startswith('"'):
+            if if_range != etag:
+                return None
+        elif if_range != get_http_date(last_modified):
+            return None
+    return parse_range_header(range_header, size)
+
+
+async def read_file_range(path: str,
+                          start: int,
+                          end: int) -> AsyncIterator[bytes]:
+    chunk_size = app_settings.archive_chunk_size
+    async with async_open(path, 'rb') as file_obj:
+        file_obj.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await file_obj.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+class RangeFileResponse(StreamingResponse):
+    """
+    206 Partial Content response with one or several byte ranges.
+
+    read(start, end) returns bytes of a range, end is inclusive.
+    """
+
+    def __init__(self,
+                 read: Callable[[int, int], AsyncIterator[bytes]],
+                 ranges: list,
+                 size: int,
+                 media_type: str,
+                 headers: dict):
+        headers = dict(headers)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            parts = [(b'', start, end)]
+            tail = b''
+        else:
+            boundary = uuid.uuid4().hex
+            parts = []
+            for start, end in ranges:
+                part_header = (
+                    f'--{boundary}\r\n'
+                    f'Content-Type: {media_type}\r\n'
+                    f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n')
+                if parts:
+                    part_header = '\r\n' + part_header
+                parts.append((part_header.encode('latin-1'), start, end))
+            tail = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+            media_type = f'multipart/byteranges; boundary={boundary}'
+        content_length = len(tail) + sum(
+            len(part_header) + end - start + 1
+            for part_header, start, end in parts)
+        headers['Content-Length'] = str(content_length)
+        super().__init__(self._iter_parts(read, parts, tail),
+                         status_code=status.HTTP_206_PARTIAL_CONTENT,
+                         headers=headers,
+                         media_type=media_type)
+
+    @staticmethod
+    async def _iter_parts(read: Callable[[int, int], AsyncIterator[bytes]],
+                          parts: list,
+                          tail: bytes) -> AsyncIterator[bytes]:
+        for part_header, start, end in parts:
+            if part_header:
+                yield part_header
+            async for chunk in read(start, end):
+                yield chunk
+        if tail:
+            yield tail
+
+
+def send_file(full_path: str,
+              media_type: str,
+              filename: str,
+              request: Optional[Request] = None,
+              etag: Optional[str] = None,
+              last_modified: Optional[datetime] = None) -> Response:
+    """
+    Send a file with conditional GET and byte range support.
+
+    The file is handed over to nginx if it is enabled, nginx serves
+    ranges itself then.
+    """
+    try:
+        stat_result = os.stat(full_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail='File not found')
+    if last_modified is None:
+        last_modified = datetime.fromtimestamp(stat_result.st_mtime,
+                                               tz=timezone.utc)
+    if etag is None:
+        etag = get_etag(stat_result.st_size, last_modified)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': get_http_date(last_modified),
+        'Accept-Ranges': 'bytes',
+    }
+    request_headers = request.headers if request is not None else {}
+    if is_not_modified(request_headers, etag, last_modified):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers=headers)
+
+    accel_uri = None
+    if app_settings.accel_redirect_enabled:
+        accel_uri = get_accel_uri(full_path)
+    if accel_uri is not None:
+        headers['X-Accel-Redirect'] = accel_uri
+        headers['Content-Disposition'] = get_content_disposition(filename)
+        return Response(media_type=media_type, headers=headers)
+
+    ranges = get_requested_ranges(request_headers,
+                                  stat_result.st_size,
+                                  etag,
+                                  last_modified)
+    if ranges == []:
+        return Response(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={'Content-Range': f'bytes */{stat_result.st_size}'})
+    if ranges:
+        headers['Content-Disposition'] = get_content_disposition(filename)
+        return RangeFileResponse(partial(read_file_range, full_path),
+                                 ranges=ranges,
+                                 size=stat_result.st_size,
+                                 media_type=media_type,
+                                 headers=headers)
+    return FileResponse(full_path,
+                        media_type=media_type,
+                        filename=filename,
+                        headers=headers,
+                        stat_result=stat_result)
+
+
+async def send_stored_file(storage_key: str,
+                           media_type: str,
+                           filename: str,
+                           request: Optional[Request] = None,
+                           etag: Optional[str] = None,
+                           last_modified: Optional[datetime] = None
+                           ) -> Response:
+    """
+    Send a file of storage, local files are sent by send_file and remote
+    ones are streamed through the application.
+    """
+    local_path = storage.get_local_path(storage_key)
+    if local_path is not None:
+        return send_file(local_path,
+                         media_type=media_type,
+                         filename=filename,
+                         request=request,
+                         etag=etag,
+                         last_modified=last_modified)
+    stat_result = await storage.stat(storage_key)
+    if stat_result is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail='File not found')
+    if last_modified is None:
+        last_modified = stat_result.modified
+    if etag is None:
+        etag = get_etag(stat_result.size, last_modified)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': get_http_date(last_modified),
+        'Accept-Ranges': 'bytes',
+    }
+    request_headers = request.headers if request is not None else {}
+    if is_not_modified(request_headers, etag, last_modified):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers=headers)
+
+    ranges = get_requested_ranges(request_headers,
+                                  stat_result.size,
+                                  etag,
+                                  last_modified)
+    if ranges == []:
+        return Response(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={'Content-Range': f'bytes */{stat_result.size}'})
+    headers['Content-Disposition'] = get_content_disposition(filename)
+    if ranges:
+        return RangeFileResponse(partial(storage.get, storage_key),
+                                 ranges=ranges,
+                                 size=stat_result.size,
+                                 media_type=media_type,
+                                 headers=headers)
+    headers['Content-Length'] = str(stat_result.size)
+    return StreamingResponse(storage.get(storage_key),
+                             media_type=media_type,
+                             headers=headers)
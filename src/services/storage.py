@@ -0,0 +1,597 @@
+import asyncio
+import bisect
+import contextlib
+import errno
+import hashlib
+import os
+import shutil
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import AsyncIterator, BinaryIO, Iterator, List, Optional
+
+from aiofile import async_open
+from starlette.concurrency import run_in_threadpool
+
+from src.core.config import app_settings
+
+OBJECTS_FOLDER = '.objects'
+ARCHIVES_FOLDER = '.archives'
+
+
+def get_object_path(file_id: uuid.UUID) -> str:
+    """
+    Place of a file in sharded layout, relative to files folder.
+
+    Two levels of 256 folders keep every folder small whatever the
+    logical tree looks like.
+    """
+    digest = hashlib.md5(file_id.bytes).hexdigest()
+    return '/'.join((OBJECTS_FOLDER, digest[:2], digest[2:4], file_id.hex))
+
+
+def get_storage_key(path: str, storage_path: Optional[str]) -> str:
+    """
+    Key of a file in storage, files without storage_path mirror their
+    logical path.
+    """
+    if storage_path is not None:
+        return storage_path
+    return path.lstrip('/')
+
+
+def get_full_path(path: str, storage_path: Optional[str]) -> str:
+    """
+    Physical path of a file in local storage.
+    """
+    return os.path.join(app_settings.files_folder_path,
+                        get_storage_key(path, storage_path))
+
+
+def get_new_storage_path(file_id: uuid.UUID) -> Optional[str]:
+    if app_settings.storage_layout == 'sharded':
+        return get_object_path(file_id)
+    return None
+
+
+def install_file(source: str,
+                 destination: str,
+                 keep_source: bool = False) -> None:
+    """
+    Put source at destination atomically, also across devices.
+    """
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if not keep_source:
+        try:
+            os.replace(source, destination)
+            return
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+    temp_path = f'{destination}.{uuid.uuid4().hex}.tmp'
+    try:
+        shutil.copyfile(source, temp_path)
+        os.replace(temp_path, destination)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+    if not keep_source:
+        os.remove(source)
+
+
+def sync_folder(folder_path: str) -> None:
+    """
+    Flush renames in a folder to disk.
+    """
+    fd = os.open(folder_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def remove_stale_files(folder_path: str, expired_at: float) -> int:
+    """
+    Remove files of a folder not changed since expired_at.
+    """
+    removed = 0
+    if not os.path.isdir(folder_path):
+        return removed
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            with contextlib.suppress(FileNotFoundError):
+                if (entry.is_file()
+                        and entry.stat().st_mtime < expired_at):
+                    os.remove(entry.path)
+                    removed += 1
+    return removed
+
+
+@dataclass
+class StorageStat:
+    size: int
+    modified: datetime
+
+
+class StorageBackend:
+    """
+    Place where file contents are kept, keys are paths relative to the
+    storage root.
+
+    Only local storage supports hard links of dedup, nginx redirects and
+    folders on disk.
+    """
+    is_local = False
+
+    async def put(self, key: str, chunks: AsyncIterator[bytes]) -> int:
+        raise NotImplementedError
+
+    async def put_file(self, key: str, file_path: str) -> None:
+        """
+        Move a local file into storage.
+        """
+        raise NotImplementedError
+
+    def get(self,
+            key: str,
+            start: int = 0,
+            end: Optional[int] = None) -> AsyncIterator[bytes]:
+        """
+        Read bytes from start to end inclusive.
+        """
+        raise NotImplementedError
+
+    async def stat(self, key: str) -> Optional[StorageStat]:
+        raise NotImplementedError
+
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def list(self, prefix: str = '') -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    def open_sync(self, key: str) -> BinaryIO:
+        """
+        Blocking reader for compression workers.
+        """
+        raise NotImplementedError
+
+    def get_local_path(self, key: str) -> Optional[str]:
+        return None
+
+
+class LocalStorage(StorageBackend):
+    is_local = True
+
+    def __init__(self, root: Optional[str] = None):
+        self._root = root
+
+    @property
+    def root(self) -> str:
+        return self._root or app_settings.files_folder_path
+
+    def get_local_path(self, key: str) -> str:
+        # absolute paths are kept as is
+        return os.path.join(self.root, key)
+
+    async def put(self, key: str, chunks: AsyncIterator[bytes]) -> int:
+        full_path = self.get_local_path(key)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        temp_path = f'{full_path}.{uuid.uuid4().hex}.tmp'
+        size = 0
+        try:
+            async with async_open(temp_path, 'wb') as temp_file:
+                async for chunk in chunks:
+                    await temp_file.write(chunk)
+                    size += len(chunk)
+            os.replace(temp_path, full_path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            raise
+        return size
+
+    async def put_file(self, key: str, file_path: str) -> None:
+        # a copy is needed if uploads are staged on another device
+        await run_in_threadpool(install_file,
+                                file_path,
+                                self.get_local_path(key))
+
+    async def get(self,
+                  key: str,
+                  start: int = 0,
+                  end: Optional[int] = None) -> AsyncIterator[bytes]:
+        chunk_size = app_settings.archive_chunk_size
+        remaining = None if end is None else end - start + 1
+        async with async_open(self.get_local_path(key), 'rb') as file_obj:
+            file_obj.seek(start)
+            while remaining is None or remaining > 0:
+                size = chunk_size
+                if remaining is not None:
+                    size = min(chunk_size, remaining)
+                    remaining -= size
+                chunk = await file_obj.read(size)
+                if not chunk:
+                    break
+                yield chunk
+
+    async def stat(self, key: str) -> Optional[StorageStat]:
+        try:
+            stat_result = os.stat(self.get_local_path(key))
+        except FileNotFoundError:
+            return None
+        return StorageStat(
+            size=stat_result.st_size,
+            modified=datetime.fromtimestamp(stat_result.st_mtime,
+                                            tz=timezone.utc))
+
+    async def delete(self, key: str) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.get_local_path(key))
+
+    async def list(self, prefix: str = '') -> AsyncIterator[str]:
+        top = self.get_local_path(os.path.dirname(prefix))
+        for dir_path, _, file_names in os.walk(top):
+            for file_name in sorted(file_names):
+                key = os.path.relpath(os.path.join(dir_path, file_name),
+                                      self.root)
+                if key.startswith(prefix):
+                    yield key
+
+    def open_sync(self, key: str) -> BinaryIO:
+        return open(self.get_local_path(key), 'rb')
+
+
+def _get_hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of keys to nodes.
+
+    Every node owns virtual_nodes points of the ring, so a new node
+    takes about 1/N of keys and other keys stay in place.
+    """
+
+    def __init__(self, nodes: List[str], virtual_nodes: int = 100):
+        points = sorted((_get_hash(f'{node}#{number}'), node)
+                        for node in nodes
+                        for number in range(virtual_nodes))
+        self._hashes = [point_hash for point_hash, _ in points]
+        self._nodes = [node for _, node in points]
+        self._count = len(set(nodes))
+
+    def iter_nodes(self, key: str) -> Iterator[str]:
+        """
+        Yield every node once, in order of preference for key.
+        """
+        seen = set()
+        start = bisect.bisect(self._hashes, _get_hash(key))
+        for index in range(len(self._nodes)):
+            node = self._nodes[(start + index) % len(self._nodes)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == self._count:
+                    return
+
+
+class VolumeStorage(StorageBackend):
+    """
+    Local disks used as one storage, every key is kept on `replicas`
+    healthy volumes chosen by consistent hashing.
+
+    Reads go to the first volume which has the key, so keys which are
+    not rebalanced yet are still found.
+    """
+
+    def __init__(self,
+                 roots: List[str],
+                 replicas: int = 1,
+                 virtual_nodes: int = 100):
+        self._volumes = {root: LocalStorage(root) for root in roots}
+        self._ring = HashRing(roots, virtual_nodes)
+        self._replicas = min(replicas, len(roots))
+
+    @staticmethod
+    def is_healthy(root: str) -> bool:
+        return os.path.isdir(root)
+
+    def get_placement(self, key: str) -> List[LocalStorage]:
+        placement = []
+        for root in self._ring.iter_nodes(key):
+            if self.is_healthy(root):
+                placement.append(self._volumes[root])
+                if len(placement) == self._replicas:
+                    break
+        if not placement:
+            raise OSError(errno.ENODEV, 'No healthy storage volume')
+        return placement
+
+    def _find(self, key: str) -> Optional[LocalStorage]:
+        for root in self._ring.iter_nodes(key):
+            volume = self._volumes[root]
+            if os.path.isfile(volume.get_local_path(key)):
+                return volume
+        return None
+
+    def _replicate(self, key: str, placement: List[LocalStorage]) -> None:
+        source_path = placement[0].get_local_path(key)
+        for volume in placement[1:]:
+            install_file(source_path,
+                         volume.get_local_path(key),
+                         keep_source=True)
+        for volume in self._volumes.values():
+            if volume not in placement:
+                # copy left from an older placement
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(volume.get_local_path(key))
+
+    def rebalance(self, key: str) -> bool:
+        """
+        Move key to volumes it belongs to, return True if it was moved.
+        """
+        placement = self.get_placement(key)
+        holders = [volume for volume in self._volumes.values()
+                   if os.path.isfile(volume.get_local_path(key))]
+        if not holders or set(holders) == set(placement):
+            return False
+        source = max(holders, key=lambda volume: os.stat(
+            volume.get_local_path(key)).st_mtime_ns)
+        for volume in placement:
+            if volume not in holders:
+                install_file(source.get_local_path(key),
+                             volume.get_local_path(key),
+                             keep_source=True)
+        for volume in holders:
+            if volume not in placement:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(volume.get_local_path(key))
+        return True
+
+    def get_local_path(self, key: str) -> Optional[str]:
+        volume = self._find(key)
+        return volume.get_local_path(key) if volume is not None else None
+
+    async def put(self, key: str, chunks: AsyncIterator[bytes]) -> int:
+        placement = self.get_placement(key)
+        size = await placement[0].put(key, chunks)
+        await run_in_threadpool(self._replicate, key, placement)
+        return size
+
+    async def put_file(self, key: str, file_path: str) -> None:
+        placement = self.get_placement(key)
+        await placement[0].put_file(key, file_path)
+        await run_in_threadpool(self._replicate, key, placement)
+
+    async def get(self,
+                  key: str,
+                  start: int = 0,
+                  end: Optional[int] = None) -> AsyncIterator[bytes]:
+        volume = self._find(key)
+        if volume is None:
+            raise FileNotFoundError(key)
+        async for chunk in volume.get(key, start, end):
+            yield chunk
+
+    async def stat(self, key: str) -> Optional[StorageStat]:
+        volume = self._find(key)
+        return await volume.stat(key) if volume is not None else None
+
+    async def delete(self, key: str) -> None:
+        for volume in self._volumes.values():
+            await volume.delete(key)
+
+    async def list(self, prefix: str = '') -> AsyncIterator[str]:
+        keys = set()
+        for root, volume in self._volumes.items():
+            if self.is_healthy(root):
+                keys.update([key async for key in volume.list(prefix)])
+        for key in sorted(keys):
+            yield key
+
+    def open_sync(self, key: str) -> BinaryIO:
+        volume = self._find(key)
+        if volume is None:
+            raise FileNotFoundError(key)
+        return volume.open_sync(key)
+
+
+class S3Storage(StorageBackend):
+    """
+    S3 compatible object storage, big files are sent by parts in
+    parallel.
+    """
+
+    def __init__(self,
+                 bucket: str,
+                 endpoint_url: Optional[str] = None,
+                 region: Optional[str] = None,
+                 access_key: Optional[str] = None,
+                 secret_key: Optional[str] = None,
+                 part_size: int = 8 * 1024 * 1024,
+                 max_concurrency: int = 4):
+        self._bucket = bucket
+        self._client_kwargs = {
+            'endpoint_url': endpoint_url,
+            'region_name': region,
+            'aws_access_key_id': access_key,
+            'aws_secret_access_key': secret_key,
+        }
+        self._part_size = part_size
+        self._max_concurrency = max_concurrency
+        self._client = None
+        self._pid = None
+
+    @property
+    def client(self):
+        # clients must not be shared with forked compression workers
+        if self._client is None or self._pid != os.getpid():
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError('boto3 is required for s3 storage')
+            self._client = boto3.client('s3', **self._client_kwargs)
+            self._pid = os.getpid()
+        return self._client
+
+    async def _call(self, method: str, **kwargs) -> dict:
+        return await run_in_threadpool(getattr(self.client, method),
+                                       Bucket=self._bucket,
+                                       **kwargs)
+
+    async def _upload_parts(self,
+                            key: str,
+                            parts: AsyncIterator[bytes]) -> None:
+        """
+        Multipart upload, at most max_concurrency parts are in memory.
+        """
+        upload = await self._call('create_multipart_upload', Key=key)
+        upload_id = upload['UploadId']
+        semaphore = asyncio.Semaphore(self._max_concurrency)
+        tasks = []
+
+        async def upload_part(part_number: int, body: bytes) -> dict:
+            try:
+                result = await self._call('upload_part',
+                                          Key=key,
+                                          UploadId=upload_id,
+                                          PartNumber=part_number,
+                                          Body=body)
+            finally:
+                semaphore.release()
+            return {'ETag': result['ETag'], 'PartNumber': part_number}
+
+        try:
+            async for body in parts:
+                await semaphore.acquire()
+                tasks.append(asyncio.create_task(
+                    upload_part(len(tasks) + 1, body)))
+            uploaded_parts = await asyncio.gather(*tasks)
+            await self._call('complete_multipart_upload',
+                             Key=key,
+                             UploadId=upload_id,
+                             MultipartUpload={'Parts': uploaded_parts})
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await self._call('abort_multipart_upload',
+                             Key=key,
+                             UploadId=upload_id)
+            raise
+
+    async def _iter_parts(
+            self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        buffer = bytearray()
+        async for chunk in chunks:
+            buffer += chunk
+            while len(buffer) >= self._part_size:
+                yield bytes(buffer[:self._part_size])
+                del buffer[:self._part_size]
+        if buffer:
+            yield bytes(buffer)
+
+    async def _iter_file_parts(self, file_path: str) -> AsyncIterator[bytes]:
+        with open(file_path, 'rb') as file_obj:
+            while True:
+                part = await run_in_threadpool(file_obj.read,
+                                               self._part_size)
+                if not part:
+                    break
+                yield part
+
+    async def put(self, key: str, chunks: AsyncIterator[bytes]) -> int:
+        parts = self._iter_parts(chunks)
+        first_part = b''
+        async for first_part in parts:
+            break
+        if len(first_part) < self._part_size:
+            await self._call('put_object', Key=key, Body=first_part)
+            return len(first_part)
+        size = 0
+
+        async def iter_all_parts() -> AsyncIterator[bytes]:
+            nonlocal size
+            size += len(first_part)
+            yield first_part
+            async for part in parts:
+                size += len(part)
+                yield part
+
+        await self._upload_parts(key, iter_all_parts())
+        return size
+
+    async def put_file(self, key: str, file_path: str) -> None:
+        if os.path.getsize(file_path) < self._part_size:
+            with open(file_path, 'rb') as file_obj:
+                await self._call('put_object', Key=key, Body=file_obj)
+        else:
+            await self._upload_parts(key, self._iter_file_parts(file_path))
+        os.remove(file_path)
+
+    async def get(self,
+                  key: str,
+                  start: int = 0,
+                  end: Optional[int] = None) -> AsyncIterator[bytes]:
+        kwargs = {}
+        if start or end is not None:
+            kwargs['Range'] = f'bytes={start}-{"" if end is None else end}'
+        result = await self._call('get_object', Key=key, **kwargs)
+        body = result['Body']
+        try:
+            while True:
+                chunk = await run_in_threadpool(
+                    body.read, app_settings.archive_chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+    async def stat(self, key: str) -> Optional[StorageStat]:
+        try:
+            result = await self._call('head_object', Key=key)
+        except self.client.exceptions.ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return StorageStat(size=result['ContentLength'],
+                           modified=result['LastModified'])
+
+    async def delete(self, key: str) -> None:
+        await self._call('delete_object', Key=key)
+
+    async def list(self, prefix: str = '') -> AsyncIterator[str]:
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = iter(paginator.paginate(Bucket=self._bucket, Prefix=prefix))
+        while True:
+            page = await run_in_threadpool(next, pages, None)
+            if page is None:
+                break
+            for item in page.get('Contents', ()):
+                yield item['Key']
+
+    def open_sync(self, key: str) -> BinaryIO:
+        return self.client.get_object(Bucket=self._bucket, Key=key)['Body']
+
+
+def create_storage() -> StorageBackend:
+    if app_settings.storage_backend == 's3':
+        return S3Storage(bucket=app_settings.s3_bucket,
+                         endpoint_url=app_settings.s3_endpoint_url,
+                         region=app_settings.s3_region,
+                         access_key=app_settings.s3_access_key,
+                         secret_key=app_settings.s3_secret_key,
+                         part_size=app_settings.s3_part_size,
+                         max_concurrency=app_settings.s3_max_concurrency)
+    if app_settings.storage_backend == 'volumes':
+        return VolumeStorage(
+            roots=app_settings.storage_volumes,
+            replicas=app_settings.storage_replicas,
+            virtual_nodes=app_settings.storage_virtual_nodes)
+    return LocalStorage()
+
+
+storage = create_storage()
@@ -0,0 +1,309 @@
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Generic, Optional, Type, TypeVar
+
+from aiofile import async_open
+from fastapi import HTTPException
+from sqlalchemy import delete, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from starlette import status
+from starlette.concurrency import run_in_threadpool
+
+from src.core.config import app_settings
+from src.db.db import Base, async_session
+from src.models.models import File, User
+from src.services.blobs import get_blob_path
+from src.services.files import UPLOADS_FOLDER, StagedFile
+from src.services.storage import (get_storage_key, remove_stale_files, storage,
+                                  sync_folder)
+
+logger = logging.getLogger(__name__)
+
+
+class Repository:
+    def create_session(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def get_session(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def write_chunk(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def complete_session(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def commit_session(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def remove_expired_sessions(self, *args, **kwargs):
+        raise NotImplementedError
+
+
+ModelType = TypeVar("ModelType", bound=Base)
+
+
+def _sync_file(file_path: str, with_hash: bool) -> Optional[str]:
+    """
+    Flush file to disk, count its SHA-256 if needed.
+    """
+    sha256 = hashlib.sha256() if with_hash else None
+    with open(file_path, 'rb') as file_obj:
+        while sha256 is not None:
+            chunk = file_obj.read(app_settings.upload_chunk_size)
+            if not chunk:
+                break
+            sha256.update(chunk)
+        os.fsync(file_obj.fileno())
+    return sha256.hexdigest() if sha256 is not None else None
+
+
+def _sync_file_folders(file_info: File) -> None:
+    """
+    Flush renames which put a committed file in place.
+    """
+    paths = [storage.get_local_path(get_storage_key(file_info.path,
+                                                    file_info.storage_path))]
+    if file_info.blob_hash is not None:
+        paths.append(get_blob_path(file_info.blob_hash))
+    for path in paths:
+        if path is not None:
+            sync_folder(os.path.dirname(path))
+
+
+class RepositoryUploadSessionDB(Repository, Generic[ModelType]):
+    """
+    Resumable uploads: chunks are written into a partial file on the
+    storage volume and the session offset is kept in database, so an
+    upload can be continued after a reconnect or a worker restart.
+    """
+
+    def __init__(self, model: Type[ModelType], file_crud=None):
+        self._model = model
+        self._file_crud = file_crud
+
+    @staticmethod
+    def get_partial_path(session_id: uuid.UUID) -> str:
+        return os.path.join(app_settings.files_folder_path,
+                            UPLOADS_FOLDER,
+                            str(session_id))
+
+    async def create_session(self,
+                             db: AsyncSession,
+                             user_obj: User,
+                             file_path: str,
+                             size: int) -> ModelType:
+        session = self._model(id=uuid.uuid1(),
+                              user_id=user_obj.id,
+                              path=file_path,
+                              size=size,
+                              offset=0)
+        partial_path = self.get_partial_path(session.id)
+        os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+        open(partial_path, 'wb').close()
+        db.add(session)
+        await db.commit()
+        await db.refresh(session)
+        return session
+
+    async def get_session(self,
+                          db: AsyncSession,
+                          user_obj: User,
+                          session_id: uuid.UUID,
+                          for_update: bool = False) -> ModelType:
+        statement = select(self._model).where(
+            self._model.id == session_id,
+            self._model.user_id == user_obj.id)
+        if for_update:
+            statement = statement.with_for_update()
+        result = await db.execute(statement=statement)
+        session = result.scalar_one_or_none()
+        if session is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail='Upload session not found')
+        return session
+
+    async def write_chunk(self,
+                          db: AsyncSession,
+                          user_obj: User,
+                          session_id: uuid.UUID,
+                          offset: int,
+                          chunks: AsyncIterator[bytes]) -> ModelType:
+        """
+        Write request body at offset, chunks may be sent again but must
+        not leave a gap after already received data.
+
+        No transaction is open while the body is received, the offset is
+        moved only if no other chunk moved it meanwhile.
+        """
+        session = await self.get_session(db=db,
+                                         user_obj=user_obj,
+                                         session_id=session_id)
+        expected_offset = session.offset
+        await db.commit()
+        if offset > expected_offset:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f'Expected offset {expected_offset}.')
+        end = offset
+        async with async_open(self.get_partial_path(session.id),
+                              'r+b') as partial_file:
+            partial_file.seek(offset)
+            async for chunk in chunks:
+                end += len(chunk)
+                if end > session.size:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail='Chunk is out of declared file size.')
+                await partial_file.write(chunk)
+        if end <= expected_offset:
+            return session
+        statement = update(self._model).where(
+            self._model.id == session.id,
+            self._model.offset == expected_offset
+        ).values(offset=end).execution_options(synchronize_session=False)
+        result = await db.execute(statement=statement)
+        await db.commit()
+        if result.rowcount == 0:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail='Upload session is changed by another request.')
+        session.offset = end
+        return session
+
+    async def complete_session(self,
+                               db: AsyncSession,
+                               session: ModelType) -> StagedFile:
+        """
+        Flush uploaded data to disk and return it ready to be saved.
+
+        The session is deleted in the same transaction the file is saved.
+        """
+        if session.offset != session.size:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f'Upload is not finished, offset {session.offset}.')
+        partial_path = self.get_partial_path(session.id)
+        if not os.path.exists(partial_path):
+            # left by a commit which failed after the file was moved
+            await db.delete(session)
+            await db.commit()
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail='Upload session not found')
+        sha256 = await run_in_threadpool(_sync_file,
+                                         partial_path,
+                                         app_settings.dedup_enabled)
+        await db.delete(session)
+        return StagedFile(filename=session.path.split('/')[-1],
+                          temp_path=partial_path,
+                          size=session.size,
+                          sha256=sha256)
+
+    async def commit_session(self,
+                             db: AsyncSession,
+                             user_obj: User,
+                             session_id: uuid.UUID) -> File:
+        """
+        Save uploaded file to its path through create_or_put_file.
+
+        A failed save brings the session back, but its partial file may
+        be moved or removed already, then the session is dropped too.
+        """
+        session = await self.get_session(db=db,
+                                         user_obj=user_obj,
+                                         session_id=session_id,
+                                         for_update=True)
+        file_path = session.path
+        staged_file = await self.complete_session(db=db, session=session)
+        try:
+            file_info = await self._file_crud.create_or_put_file(
+                db=db,
+                user_obj=user_obj,
+                file_obj=staged_file,
+                file_path=file_path)
+        except Exception:
+            await self._drop_lost_session(db=db, session_id=session_id)
+            raise
+        await run_in_threadpool(_sync_file_folders, file_info)
+        return file_info
+
+    async def _drop_lost_session(self,
+                                 db: AsyncSession,
+                                 session_id: uuid.UUID) -> None:
+        try:
+            await db.rollback()
+            if os.path.exists(self.get_partial_path(session_id)):
+                return
+            statement = delete(self._model).where(
+                self._model.id == session_id
+            ).execution_options(synchronize_session=False)
+            await db.execute(statement=statement)
+            await db.commit()
+        except Exception:
+            logger.exception('Upload session %s is not dropped', session_id)
+
+    async def delete_session(self, db: AsyncSession, session: ModelType):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.get_partial_path(session.id))
+        await db.delete(session)
+        await db.commit()
+
+    async def remove_expired_sessions(self, db: AsyncSession) -> int:
+        """
+        Drop sessions older than upload_session_ttl with their partial
+        files, staged files left by interrupted uploads go too.
+        """
+        ttl = app_settings.upload_session_ttl
+        statement = delete(self._model).where(
+            self._model.created_at < datetime.utcnow() - timedelta(
+                seconds=ttl)
+        ).execution_options(synchronize_session=False)
+        result = await db.execute(statement=statement)
+        await db.commit()
+        # a partial file is created with its session, so the file of a
+        # live session is never older than ttl
+        await run_in_threadpool(
+            remove_stale_files,
+            os.path.join(app_settings.files_folder_path, UPLOADS_FOLDER),
+            time.time() - ttl)
+        return result.rowcount
+
+
+class UploadSweeper:
+    """
+    Periodic removal of abandoned uploads.
+    """
+
+    def __init__(self, repository: RepositoryUploadSessionDB):
+        self._repository = repository
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(app_settings.upload_cleanup_interval)
+            try:
+                async with async_session() as db:
+                    removed = await self._repository.remove_expired_sessions(
+                        db=db)
+                logger.info('Removed %s expired upload sessions', removed)
+            except Exception:
+                logger.exception('Expired upload sessions are not removed')
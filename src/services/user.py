@@ -1,17 +1,29 @@
+import hashlib
+import logging
+import time
+from datetime import datetime, timedelta
 from typing import Generic, Optional, Type, TypeVar, Union
+from uuid import UUID
 
+import aioredis
+import orjson
 from fastapi import Depends, HTTPException
 from fastapi.encoders import jsonable_encoder
 from fastapi.security import OAuth2PasswordBearer
-from jose import jwt
+from jose import JWTError, jwt
 from pydantic import BaseModel
+from sqlalchemy import func, or_, true, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from starlette import status
 
 from src.core.config import app_settings
-from src.db.db import Base, get_session
+from src.db.db import Base, get_cache_ttl, get_read_session, get_session
 from src.models.models import User
+from src.schemas.user_schemas import CurrentUser
+from src.services.cache import LRUCache, redis_cache
+
+logger = logging.getLogger(__name__)
 
 
 class Repository:
@@ -21,16 +33,39 @@ class Repository:
     def create(self, *args, **kwargs):
         raise NotImplementedError
 
+    def invalidate_token(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def invalidate_user(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def get_usage(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def check_quota(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def add_usage(self, *args, **kwargs):
+        raise NotImplementedError
+
 
 ModelType = TypeVar("ModelType", bound=Base)
 CreateSchemaType = TypeVar("CreateSchemaType", bound=BaseModel)
 
 
+def quota_exceeded() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail='Storage quota exceeded.')
+
+
 class RepositoryUserDB(Repository, Generic[ModelType, CreateSchemaType]):
     oauth2_scheme = OAuth2PasswordBearer(tokenUrl='v1/token')
 
     def __init__(self, model: Type[ModelType]):
         self._model = model
+        self._token_cache = LRUCache(
+            max_size=app_settings.auth_cache_max_size)
 
     async def get_by_username(self,
                               db: AsyncSession,
@@ -51,6 +86,77 @@ class RepositoryUserDB(Repository, Generic[ModelType, CreateSchemaType]):
         await db.refresh(db_obj)
         return db_obj
 
+    @staticmethod
+    def _get_quota_filter(column, quota_column, default, delta: int):
+        """
+        Condition that column still fits the quota after adding delta.
+        """
+        if delta <= 0:
+            return true()
+        if default is None:
+            return or_(quota_column.is_(None),
+                       column + delta <= quota_column)
+        return column + delta <= func.coalesce(quota_column, default)
+
+    async def get_usage(self, db: AsyncSession, user_id: UUID) -> dict:
+        """
+        Return stored bytes and files of a user and the quotas.
+        """
+        statement = select(self._model.used_size,
+                           self._model.file_count,
+                           self._model.quota_size,
+                           self._model.quota_files).where(
+            self._model.id == user_id)
+        result = await db.execute(statement=statement)
+        usage = dict(result.mappings().one())
+        if usage['quota_size'] is None:
+            usage['quota_size'] = app_settings.user_quota_size
+        if usage['quota_files'] is None:
+            usage['quota_files'] = app_settings.user_quota_files
+        return usage
+
+    async def check_quota(self,
+                          db: AsyncSession,
+                          user_id: UUID,
+                          size: int,
+                          file_count: int) -> None:
+        """
+        Reject an upload early, before its body is stored.
+        """
+        usage = await self.get_usage(db=db, user_id=user_id)
+        for used, quota, delta in (
+                (usage['used_size'], usage['quota_size'], size),
+                (usage['file_count'], usage['quota_files'], file_count)):
+            if delta > 0 and quota is not None and used + delta > quota:
+                raise quota_exceeded()
+
+    async def add_usage(self,
+                        db: AsyncSession,
+                        user_id: UUID,
+                        size: int,
+                        file_count: int) -> None:
+        """
+        Change usage counters if they stay within quotas, the row is
+        locked until the caller commits and calls invalidate_user.
+        """
+        statement = update(self._model).where(
+            self._model.id == user_id,
+            self._get_quota_filter(self._model.used_size,
+                                   self._model.quota_size,
+                                   app_settings.user_quota_size,
+                                   size),
+            self._get_quota_filter(self._model.file_count,
+                                   self._model.quota_files,
+                                   app_settings.user_quota_files,
+                                   file_count)
+        ).values(
+            used_size=self._model.used_size + size,
+            file_count=self._model.file_count + file_count
+        ).execution_options(synchronize_session=False)
+        result = await db.execute(statement=statement)
+        if result.rowcount == 0:
+            raise quota_exceeded()
+
     async def get_token(self, db: AsyncSession, username: str, password: str):
         user: Union[User, None] = await self.authenticate(db,
                                                           username,
@@ -60,16 +166,18 @@ class RepositoryUserDB(Repository, Generic[ModelType, CreateSchemaType]):
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect username or password",
                 headers={"WWW-Authenticate": "Bearer"})
-        token = jwt.encode({'usr': user.username},
+        expire = datetime.utcnow() + timedelta(
+            minutes=app_settings.token_expire_minutes)
+        token = jwt.encode({'usr': user.username, 'exp': expire},
                            app_settings.secret_key,
-                           algorithm='HS256')
+                           algorithm=app_settings.algorithm)
         return token
 
     async def authenticate(self,
                            db: AsyncSession,
                            username: str,
                            password: str):
-        user = await self.get_user_by_username(db=db, username=username)
+        user = await self._get_user_by_username(db=db, username=username)
         if not user:
             return False
         if user.password != password:
@@ -81,22 +189,140 @@ class RepositoryUserDB(Repository, Generic[ModelType, CreateSchemaType]):
         results = await db.execute(statement=statement)
         return results.scalar_one_or_none()
 
-    async def get_current_user(self,
-                               db: AsyncSession = Depends(get_session),
-                               token: str = Depends(oauth2_scheme)):
+    @staticmethod
+    def _get_token_key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @staticmethod
+    async def _get_redis_client() -> Optional[aioredis.Redis]:
+        if not app_settings.auth_cache_redis_enabled:
+            return None
+        cache = redis_cache()
+        if cache is None:
+            return None
+        return await cache._client
+
+    async def _get_cached_user(self, token_key: str) -> Optional[CurrentUser]:
+        user = self._token_cache.get(token_key)
+        if user is not None:
+            return user
+        try:
+            client = await self._get_redis_client()
+            if client is None:
+                return None
+            data = await client.get(f'auth_token_{token_key}')
+            ttl = await client.ttl(f'auth_token_{token_key}')
+        except (aioredis.RedisError, OSError) as error:
+            logger.warning('Token cache is not available: %s', error)
+            return None
+        if data is None:
+            return None
+        user = CurrentUser.parse_obj(orjson.loads(data))
+        self._token_cache.set(token_key,
+                              user,
+                              ttl=min(ttl, app_settings.auth_cache_ttl))
+        return user
+
+    async def _set_cached_user(self,
+                               token_key: str,
+                               user: CurrentUser,
+                               expire_at: float) -> None:
+        ttl = min(app_settings.auth_cache_ttl, int(expire_at - time.time()))
+        if ttl <= 0:
+            return
+        self._token_cache.set(token_key, user, ttl=ttl)
+        try:
+            client = await self._get_redis_client()
+            if client is None:
+                return
+            user_key = f'auth_user_tokens_{user.id}'
+            transaction = client.multi_exec()
+            transaction.set(f'auth_token_{token_key}',
+                            orjson.dumps(user.dict()),
+                            expire=ttl)
+            transaction.sadd(user_key, token_key)
+            transaction.expire(user_key, app_settings.auth_cache_ttl)
+            await transaction.execute()
+        except (aioredis.RedisError, OSError) as error:
+            logger.warning('Token cache is not available: %s', error)
+
+    async def invalidate_token(self, token: str) -> None:
+        """
+        Forget a token, next request with it is checked in database.
+        """
+        token_key = self._get_token_key(token)
+        self._token_cache.delete(token_key)
+        try:
+            client = await self._get_redis_client()
+            if client is not None:
+                await client.delete(f'auth_token_{token_key}')
+        except (aioredis.RedisError, OSError) as error:
+            logger.warning('Token cache is not available: %s', error)
+
+    async def invalidate_user(self, user_id: UUID) -> None:
+        """
+        Forget all tokens of a user, call it after the user row is
+        changed or deleted.
+
+        Other workers keep their own entries up to auth_cache_ttl.
+        """
+        for token_key, user in self._token_cache.items():
+            if user.id == user_id:
+                self._token_cache.delete(token_key)
+        try:
+            client = await self._get_redis_client()
+            if client is None:
+                return
+            user_key = f'auth_user_tokens_{user_id}'
+            token_keys = await client.smembers(user_key, encoding='utf-8')
+            await client.delete(user_key,
+                                *(f'auth_token_{token_key}'
+                                  for token_key in token_keys))
+        except (aioredis.RedisError, OSError) as error:
+            logger.warning('Token cache is not available: %s', error)
+
+    async def get_current_user(
+            self,
+            db: AsyncSession = Depends(get_session),
+            read_db: AsyncSession = Depends(get_read_session),
+            token: str = Depends(oauth2_scheme)) -> CurrentUser:
+        """
+        Resolve token to user, verified tokens are cached until
+        auth_cache_ttl or token expiration, whichever comes first.
+
+        The user is read from replica, a user not replicated yet is read
+        from primary.
+        """
         credentials_exception = HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials",
             headers={"WWW-Authenticate": "Bearer"},)
-        payload = jwt.decode(token,
-                             app_settings.secret_key,
-                             algorithms='HS256')
+        token_key = self._get_token_key(token)
+        user = await self._get_cached_user(token_key)
+        if user is not None:
+            return user
+        try:
+            payload = jwt.decode(token,
+                                 app_settings.secret_key,
+                                 algorithms=app_settings.algorithm,
+                                 options={'require_exp': True})
+        except JWTError:
+            raise credentials_exception
         username: str = payload.get("usr")
         if username is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                                detail="Could not validate credentials",
-                                headers={"WWW-Authenticate": "Bearer"},)
-        user = await self._get_user_by_username(db=db, username=username)
-        if user is None:
             raise credentials_exception
+        user_obj = await self._get_user_by_username(db=read_db,
+                                                    username=username)
+        if user_obj is None and read_db is not db:
+            read_db = db
+            user_obj = await self._get_user_by_username(db=db,
+                                                        username=username)
+        if user_obj is None:
+            raise credentials_exception
+        user = CurrentUser.from_orm(user_obj)
+        expire_at = time.time() + get_cache_ttl(read_db,
+                                                app_settings.auth_cache_ttl)
+        await self._set_cached_user(token_key,
+                                    user,
+                                    min(expire_at, payload['exp']))
         return user
@@ -1,30 +1,46 @@
+import asyncio
+import functools
 import logging
 import os
-import tarfile
-import zipfile
-from io import BytesIO
+import time
+import uuid
+from datetime import timezone
+from typing import AsyncIterator, BinaryIO, Union
 
-import py7zr
+from aiofile import async_open
 from fastapi import HTTPException
 from fastapi_cache.backends.redis import RedisCacheBackend
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
+from starlette.concurrency import run_in_threadpool
 
 from src.core.config import app_settings
+from src.db.db import get_cache_ttl
+from src.models.models import User
 from src.schemas import file_schemas
+from src.services.archive import (MEDIA_TYPES, STREAMABLE_TYPES, ArchiveMember,
+                                  compress_to_file, get_archive_members,
+                                  get_fingerprint)
+from src.services.archive_cache import archive_cache
 from src.services.base import directory_crud, file_crud
-from src.services.cache import get_cache_or_data
+from src.services.cache import (get_cache_or_data, get_entry, get_file_key,
+                                get_many_cache, make_entry, set_many_cache)
+from src.services.files import RESERVED_FOLDERS, is_reserved_path
+from src.services.pool import compression_pool
+from src.services.storage import get_storage_key, storage
 
 logger = logging.getLogger(__name__)
 
+FOLLOW_INTERVAL = 0.05
 
-async def get_file_info(db: AsyncSession, path: str):
+
+async def get_file_info(db: AsyncSession, path: str, user_id: uuid.UUID):
     if path.find('/') != -1:
         file_info = await file_crud.get_file_info_by_path(db=db,
                                                           file_path=path)
     else:
         file_info = await file_crud.get_file_info_by_id(db=db, file_id=path)
-    if not file_info:
+    if not file_info or file_info.user_id != user_id:
         logger.error('Raise 404 for file with path/id %s', path)
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -33,6 +49,51 @@ async def get_file_info(db: AsyncSession, path: str):
     return file_info
 
 
+async def get_files_info(db: AsyncSession,
+                         cache: RedisCacheBackend,
+                         user_id: uuid.UUID,
+                         paths: list[str]) -> tuple[list[dict], list[str]]:
+    """
+    Resolve many paths or ids of files of the user with one cache round
+    trip for reading, one query for all misses and one pipeline to cache
+    them.
+    """
+    keys = {path: get_file_key(user_id, path)
+            for path in dict.fromkeys(paths)}
+    values = await get_many_cache(cache, list(keys.values()))
+    entries = {key: get_entry(value) for key, value in values.items()}
+    now = time.time()
+    missed = [path for path, key in keys.items()
+              if not entries.get(key) or entries[key]['fresh_until'] <= now]
+    if missed:
+        loaded = await file_crud.get_files_info_by_paths(db=db,
+                                                         user_id=user_id,
+                                                         paths=missed)
+        file_cache_ttl = get_cache_ttl(db, app_settings.file_cache_ttl)
+        items = []
+        for path in missed:
+            file_info = loaded.get(path)
+            if file_info is None:
+                expire = app_settings.cache_negative_ttl
+                entry = make_entry(None, expire, HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail='File not found'))
+            else:
+                expire = file_cache_ttl + app_settings.cache_stale_ttl
+                entry = make_entry(
+                    file_schemas.File.from_orm(file_info).dict(),
+                    file_cache_ttl)
+            key = keys[path]
+            items.append((key, entry, expire, key not in values))
+            entries[key] = entry
+        await set_many_cache(cache, items)
+    files = [entries[key]['data'] for key in keys.values()
+             if entries[key]['data'] is not None]
+    not_found = [path for path, key in keys.items()
+                 if entries[key]['data'] is None]
+    return files, not_found
+
+
 async def get_path_by_id(db: AsyncSession,
                          obj_id: str,
                          cache: RedisCacheBackend) -> str:
@@ -43,78 +104,48 @@ async def get_path_by_id(db: AsyncSession,
         db_func_obj=file_crud.get_file_info_by_id,
         data_schema=file_schemas.PathSchema,
         db_func_args=(db, obj_id),
-        cache_expire=3600)
+        cache_expire=get_cache_ttl(db, 3600))
     if not file_info:
         dir_info = await get_cache_or_data(
-            redis_key=redis_key,
+            redis_key=f'get_dir_path_by_id_{obj_id}',
             cache=cache,
             db_func_obj=directory_crud.get_dir_info_by_id,
             data_schema=file_schemas.PathSchema,
             db_func_args=(db, obj_id),
-            cache_expire=3600)
+            cache_expire=get_cache_ttl(db, 3600))
         if not dir_info:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail='Directory or file not found')
-        return dir_info.get()
+        return dir_info.get('path')
     return file_info.get('path')
 
 
-def get_files_paths_by_folder(full_path: str) -> list:
-    return [
-        os.path.join(full_path, f)
-        for f in os.listdir(full_path)
-        if os.path.isfile(os.path.join(full_path, f))]
-
-
-def compress_file(
-        write_to_file_func, full_path: str) -> None:
-    if os.path.isfile(full_path):
-        write_to_file_func(full_path)
-    else:
-        files_paths = get_files_paths_by_folder(full_path)
-        for file_path in files_paths:
-            write_to_file_func(file_path)
-
-
-def compress(io_obj: BytesIO,
-             path: str,
-             compression_type: str):
-    full_path = app_settings.files_folder_path + path
-    if compression_type == 'zip':
-        with zipfile.ZipFile(io_obj, mode='w',
-                             compression=zipfile.ZIP_DEFLATED) as zip_io:
-            compress_file(
-                write_to_file_func=zip_io.write,
-                full_path=full_path
-            )
-            zip_io.close()
-        return io_obj, 'application/x-zip-compressed'
-    elif compression_type == 'tar':
-        with tarfile.open(fileobj=io_obj, mode='w:gz') as tar:
-            compress_file(
-                write_to_file_func=tar.add,
-                full_path=full_path
-            )
-            tar.close()
-        return io_obj, 'application/x-gtar'
-    elif compression_type == '7z':
-        with py7zr.SevenZipFile(io_obj, mode='w') as seven_zip:
-            compress_file(
-                write_to_file_func=seven_zip.write,
-                full_path=full_path
-            )
-        return io_obj, 'application/x-7z-compressed'
-    else:
-        return 'Error format archive'
+def normalize_archive_path(path: str) -> str:
+    """
+    Path without empty, . and .. parts, .. must not leave the root.
+    """
+    parts = []
+    for part in path.split('/'):
+        if part in ('', '.'):
+            continue
+        if part != '..':
+            parts.append(part)
+        elif parts:
+            parts.pop()
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail='Path is outside of the storage.')
+    return '/' + '/'.join(parts)
 
 
-async def get_compressed_file_with_media_type(db: AsyncSession,
-                                              cache: RedisCacheBackend,
-                                              path: str,
-                                              compression_type: str
-                                              ) -> tuple[BytesIO, str]:
-    io_obj = BytesIO()
+async def resolve_archive_path(db: AsyncSession,
+                               cache: RedisCacheBackend,
+                               path: str) -> str:
+    """
+    Return normalized path of a file or a folder given by path or id.
+    """
     if path.find('/') == -1:
         path = await get_path_by_id(db=db,
                                     obj_id=path,
@@ -124,8 +155,149 @@ async def get_compressed_file_with_media_type(db: AsyncSession,
             status_code=status.HTTP_400_BAD_REQUEST,
             detail='Path must starts with / .'
         )
-    refreshed_io, media_type = compress(
-        io_obj=io_obj,
-        path=path,
-        compression_type=compression_type)
-    return refreshed_io, media_type
+    path = normalize_archive_path(path)
+    if is_reserved_path(path):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Path is reserved.')
+    return path
+
+
+async def get_archive_files(db: AsyncSession,
+                            user_id: uuid.UUID,
+                            path: str) -> tuple[list, int]:
+    """
+    Files of the user to archive and length of the path prefix which is
+    cut from their names in archive.
+    """
+    file_info = await file_crud.get_file_info_by_path(db=db, file_path=path)
+    if file_info and file_info.user_id == user_id:
+        return [file_info], len(file_info.path) - len(file_info.name)
+    files = await file_crud.get_list_by_folder(db=db,
+                                               folder_path=path,
+                                               recursive=True,
+                                               user_id=user_id)
+    return files, len(path.rstrip('/') + '/')
+
+
+async def resolve_archive_members(db: AsyncSession,
+                                  user_id: uuid.UUID,
+                                  path: str) -> list:
+    """
+    Return archive members of a file or a folder, only files of the user
+    are included.
+
+    In sharded layout and in remote storage folders exist only in
+    database.
+    """
+    not_found_exception = HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail='Directory or file not found')
+    files, prefix_length = await get_archive_files(db=db,
+                                                   user_id=user_id,
+                                                   path=path)
+    if not files:
+        raise not_found_exception
+    if app_settings.storage_layout == 'sharded' or not storage.is_local:
+        return [
+            ArchiveMember(
+                source=get_storage_key(file.path, file.storage_path),
+                arcname=file.path[prefix_length:],
+                size=file.size,
+                mtime=file.created_at.replace(
+                    tzinfo=timezone.utc).timestamp())
+            for file in files]
+    full_path = app_settings.files_folder_path + path
+    if not os.path.exists(full_path):
+        raise not_found_exception
+    exclude = [os.path.join(app_settings.files_folder_path, folder)
+               for folder in RESERVED_FOLDERS]
+    members = await run_in_threadpool(get_archive_members, full_path, exclude)
+    # files of other users may share the folder
+    arcnames = {file.path[prefix_length:] for file in files}
+    members = [member for member in members if member.arcname in arcnames]
+    if not members:
+        raise not_found_exception
+    return members
+
+
+async def iter_archive_file(archive_file: BinaryIO,
+                            job: asyncio.Future,
+                            follow: bool) -> AsyncIterator[bytes]:
+    """
+    Send archive from the file written by a compression worker.
+
+    With follow the file is sent while it grows, otherwise only when
+    the worker is finished.
+    """
+    try:
+        if not follow:
+            await job
+        async with async_open(archive_file) as archive:
+            while True:
+                chunk = await archive.read(app_settings.archive_chunk_size)
+                if chunk:
+                    yield chunk
+                elif job.done():
+                    job.result()
+                    break
+                else:
+                    await asyncio.wait([job], timeout=FOLLOW_INTERVAL)
+    except Exception:
+        logger.exception('Compression of %s failed', archive_file.name)
+        raise
+    finally:
+        archive_file.close()
+
+
+def _commit_archive(temp_path: str,
+                    entry_path: str,
+                    job: asyncio.Future) -> None:
+    if job.cancelled() or job.exception():
+        archive_cache.discard(temp_path)
+    else:
+        archive_cache.commit(temp_path, entry_path)
+
+
+async def get_compressed_file_with_media_type(
+        db: AsyncSession,
+        cache: RedisCacheBackend,
+        user_obj: User,
+        path: str,
+        compression_type: str
+) -> tuple[Union[str, AsyncIterator[bytes]], str]:
+    """
+    Return path of a cached archive or a stream of a new one.
+    """
+    path = await resolve_archive_path(db=db, cache=cache, path=path)
+    members = await resolve_archive_members(db=db,
+                                            user_id=user_obj.id,
+                                            path=path)
+    media_type = MEDIA_TYPES[compression_type]
+    fingerprint = get_fingerprint(members)
+    cached_path = archive_cache.get(path, compression_type, fingerprint)
+    if cached_path:
+        logger.info('Send cached archive of %s', path)
+        return cached_path, media_type
+    temp_path = archive_cache.reserve(path)
+    # opened before the job starts, the file is renamed once it is done
+    archive_file = open(temp_path, 'rb')
+    try:
+        job = await compression_pool.submit(compress_to_file,
+                                            temp_path,
+                                            members,
+                                            compression_type)
+    except Exception:
+        archive_file.close()
+        archive_cache.discard(temp_path)
+        raise
+    entry_path = archive_cache.get_entry_path(path,
+                                              compression_type,
+                                              fingerprint)
+    job.add_done_callback(
+        functools.partial(_commit_archive, temp_path, entry_path))
+    archive_iterator = iter_archive_file(
+        archive_file=archive_file,
+        job=job,
+        follow=compression_type in STREAMABLE_TYPES)
+    return archive_iterator, media_type
@@ -0,0 +1,53 @@
+"""
+Move stored files to volumes they belong to.
+
+Run from repository root after STORAGE_VOLUMES or STORAGE_REPLICAS is
+changed and the service is restarted with the new settings:
+
+    python -m src.tools.rebalance
+
+Only files whose placement changed are copied. Files are served from
+old volumes until they are moved, the tool may be stopped and run again
+at any time.
+"""
+import asyncio
+import logging
+
+from starlette.concurrency import run_in_threadpool
+
+from src.core.config import app_settings
+from src.services.blobs import BLOBS_FOLDER
+from src.services.files import UPLOADS_FOLDER
+from src.services.storage import VolumeStorage, storage
+
+logger = logging.getLogger(__name__)
+
+LOG_EVERY = 1000
+
+
+def is_stored_file(key: str) -> bool:
+    top_folder = key.split('/')[0]
+    return (top_folder not in (UPLOADS_FOLDER, BLOBS_FOLDER)
+            and not key.endswith('.tmp'))
+
+
+async def rebalance() -> None:
+    if not isinstance(storage, VolumeStorage):
+        logger.error('Files of %s storage can not be rebalanced',
+                     app_settings.storage_backend)
+        return
+    total = 0
+    moved = 0
+    async for key in storage.list():
+        if not is_stored_file(key):
+            continue
+        if await run_in_threadpool(storage.rebalance, key):
+            moved += 1
+        total += 1
+        if total % LOG_EVERY == 0:
+            logger.info('Checked %s files, %s moved', total, moved)
+    logger.info('Done, %s of %s files moved', moved, total)
+
+
+if __name__ == '__main__':
+    asyncio.run(rebalance())
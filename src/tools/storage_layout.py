@@ -0,0 +1,129 @@
+"""
+Move stored files between mirror and sharded layouts.
+
+Set STORAGE_LAYOUT to the target layout first, so new uploads are not
+left behind, then run from repository root:
+
+    python -m src.tools.storage_layout sharded --prune
+
+The tool may be stopped and run again at any time.
+"""
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import uuid
+from typing import Optional
+
+from fastapi_cache import caches, close_caches
+from fastapi_cache.backends.redis import CACHE_KEY, RedisCacheBackend
+from sqlalchemy.future import select
+from starlette.concurrency import run_in_threadpool
+
+from src.core.config import app_settings
+from src.db.db import async_session
+from src.models.models import File
+from src.services.base import file_crud
+from src.services.files import RESERVED_FOLDERS
+from src.services.storage import get_full_path, get_object_path, storage
+
+logger = logging.getLogger(__name__)
+
+
+def move_file(source: str, destination: str) -> bool:
+    """
+    Return False if the file is in neither place.
+    """
+    try:
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(source, destination)
+    except FileNotFoundError:
+        # moved by a previous run which was stopped before commit
+        return os.path.exists(destination)
+    return True
+
+
+def prune_empty_dirs(root: str) -> None:
+    for dir_path, _, _ in os.walk(root, topdown=False):
+        top_folder = os.path.relpath(dir_path, root).split(os.sep)[0]
+        if dir_path == root or top_folder in RESERVED_FOLDERS:
+            continue
+        with contextlib.suppress(OSError):
+            # fails for folders which are not empty
+            os.rmdir(dir_path)
+
+
+async def migrate_batch(layout: str,
+                        after_id: Optional[uuid.UUID],
+                        batch_size: int) -> tuple[Optional[uuid.UUID], int]:
+    """
+    Move a batch of files, rows being changed by uploads are skipped.
+    """
+    if layout == 'sharded':
+        statement = select(File).where(File.storage_path.is_(None))
+    else:
+        statement = select(File).where(File.storage_path.isnot(None))
+    if after_id is not None:
+        statement = statement.where(File.id > after_id)
+    statement = statement.order_by(File.id).limit(
+        batch_size).with_for_update(skip_locked=True)
+    moved = []
+    async with async_session() as db:
+        results = await db.execute(statement=statement)
+        files = results.scalars().all()
+        for file_info in files:
+            storage_path = None
+            if layout == 'sharded':
+                storage_path = get_object_path(file_info.id)
+            source = get_full_path(file_info.path, file_info.storage_path)
+            destination = get_full_path(file_info.path, storage_path)
+            if not await run_in_threadpool(move_file, source, destination):
+                logger.error('File %s is not found at %s',
+                             file_info.path, source)
+                continue
+            file_info.storage_path = storage_path
+            moved.append(file_info)
+        await db.commit()
+    for file_info in moved:
+        await file_crud.update_cache(file_info)
+    return (files[-1].id if files else None), len(moved)
+
+
+async def migrate(layout: str, batch_size: int, prune: bool) -> None:
+    if not storage.is_local:
+        logger.error('Layout of %s storage can not be changed',
+                     app_settings.storage_backend)
+        return
+    if app_settings.storage_layout != layout:
+        logger.warning('STORAGE_LAYOUT is %s, new uploads will not use '
+                       '%s layout', app_settings.storage_layout, layout)
+    caches.set(CACHE_KEY, RedisCacheBackend(app_settings.redis_url))
+    after_id = None
+    total = 0
+    try:
+        while True:
+            after_id, moved = await migrate_batch(layout,
+                                                  after_id,
+                                                  batch_size)
+            if after_id is None:
+                break
+            total += moved
+            logger.info('Moved %s files', total)
+    finally:
+        await close_caches()
+    if prune:
+        await run_in_threadpool(prune_empty_dirs,
+                                app_settings.files_folder_path)
+    logger.info('Done, %s files moved to %s layout', total, layout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('layout', choices=('mirror', 'sharded'))
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--prune',
+                        action='store_true',
+                        help='remove folders left empty')
+    args = parser.parse_args()
+    asyncio.run(migrate(args.layout, args.batch_size, args.prune))